@@ -0,0 +1,190 @@
+import argparse,collections,concurrent.futures,json,os,sys,time
+
+import bitplane_cache
+import bitplanelib
+
+# Converts a batch of images described in a json manifest, using a process pool
+# Example: bitplane_batch.py assets.json -j 8
+#
+# manifest: list of entries (paths are relative to the manifest directory)
+# [
+#   {"input": "tiles.png", "output": "tiles.bin", "palette": "game.json",
+#    "format": "raw", "nb_planes": 5, "palette_precision_mask": 240,
+#    "generate_mask": true, "blit_pad": true, "mask_color": [0,0,0], "add_dimensions": false,
+#    "layout": "interleaved"},
+#   {"input": "ship.png", "output": "ship.spr", "palette": [[0,0,0],[255,255,255],[255,0,0],[0,0,255]],
+#    "format": "sprite", "sprite_fmode": 3},
+#   {"input": "walk.png", "output": "walk.spr", "palette": "walk.json",
+#    "format": "spritesheet", "frame_size": [16,24], "sprite_fmode": 0},
+#   {"input": "title.png", "output": "title_pal.s", "format": "palette", "palette_format": ["copperlist"]}
+# ]
+# "palette" is a list of RGB triplets, a .json palette file or a JASC .pal file.
+# "layout" is "consecutive" (default), "interleaved" or [plane_offset,modulo] in bytes.
+# "palette" format entries dump the given palette, or the palette extracted from "input"
+
+# cache_stats: cache hits, misses and evictions of the conversion (None without cache)
+BatchResult = collections.namedtuple("BatchResult","input output size error cached cache_stats")
+
+# one cache per directory and process, so that its tracked size spares directory scans
+_caches = {}
+
+
+def load_manifest(filename):
+    """
+    loads a json manifest, and makes its paths relative to the manifest directory
+    """
+    with open(filename) as f:
+        entries = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    for entry in entries:
+        for key in ("input","output","palette"):
+            value = entry.get(key)
+            if isinstance(value,str):
+                entry[key] = os.path.join(base_dir,value)
+    return entries
+
+
+def load_palette(palette,palette_precision_mask=0xFF):
+    if isinstance(palette,str):
+        if palette.lower().endswith(".pal"):
+            return [tuple(c) for c in bitplanelib.palette_fromjascpalette(palette,palette_precision_mask)]
+        return bitplanelib.palette_load_from_json(palette)
+    return [tuple(c) for c in palette]
+
+
+def load_layout(layout):
+    # json has no tuples
+    return layout if isinstance(layout,str) else tuple(layout)
+
+
+def convert_entry(entry,cache=None):
+    """
+    converts one manifest entry, returns the number of bytes written
+    cache: optional bitplane_cache.ConversionCache used for raw & sprite conversions
+    """
+    fmt = entry.get("format","raw")
+    palette_precision_mask = entry.get("palette_precision_mask",0xFF)
+    palette = entry.get("palette")
+    if palette is not None:
+        palette = load_palette(palette,palette_precision_mask)
+    output = entry.get("output")
+    if output is None:
+        raise bitplanelib.BitplaneException("{}: no output".format(entry.get("input")))
+
+    converter = cache or bitplanelib
+
+    if fmt == "raw":
+        out = converter.palette_image2raw(entry["input"],output,palette,
+                add_dimensions=entry.get("add_dimensions",False),
+                forced_nb_planes=entry.get("nb_planes"),
+                palette_precision_mask=palette_precision_mask,
+                generate_mask=entry.get("generate_mask",False),
+                blit_pad=entry.get("blit_pad",False),
+                mask_color=tuple(entry.get("mask_color",(0,0,0))),
+                layout=load_layout(entry.get("layout",bitplanelib.BITPLANE_LAYOUT_CONSECUTIVE)))
+        return len(out)
+    elif fmt == "sprite":
+        out = converter.palette_image2sprite(entry["input"],output,palette,
+                palette_precision_mask=palette_precision_mask,
+                sprite_fmode=entry.get("sprite_fmode",0))
+        return len(out)
+    elif fmt == "spritesheet":
+        sheet = bitplanelib.palette_image2spritesheet(entry["input"],output,palette,
+                frame_size=entry.get("frame_size"),frames=entry.get("frames"),
+                palette_precision_mask=palette_precision_mask,
+                sprite_fmode=entry.get("sprite_fmode",0),
+                position=tuple(entry.get("position",(0,0))),
+                with_table=entry.get("with_table",True))
+        return len(sheet.data)
+    elif fmt == "palette":
+        if palette is None:
+            palette = bitplanelib.palette_extract(entry["input"],palette_precision_mask)
+        pformat = 0
+        for name in entry.get("palette_format",["asmmot"]):
+            pformat |= bitplanelib.PALETTE_FORMATS[name]
+        bitplanelib.palette_dump(palette,output,pformat,entry.get("high_precision",False))
+        return os.path.getsize(output)
+    else:
+        raise bitplanelib.BitplaneException("{}: unknown format {}".format(entry.get("input"),fmt))
+
+
+def _cache_stats_delta(cache,before):
+    if cache is None:
+        return None
+    return {name:value-before[name] for name,value in cache.stats().items()}
+
+
+def _convert_entry_safe(entry,cache_dir=None):
+    cache = None
+    if cache_dir:
+        cache = _caches.get(cache_dir)
+        if cache is None:
+            cache = _caches[cache_dir] = bitplane_cache.ConversionCache(cache_dir)
+    before = cache.stats() if cache else None
+    try:
+        size = convert_entry(entry,cache)
+    except bitplanelib.BitplaneException as e:
+        return 0,str(e),False,_cache_stats_delta(cache,before)
+    except (OSError,ValueError,KeyError) as e:
+        # missing/unreadable files, invalid palette files or manifest values
+        return 0,"{}: {}: {}".format(entry.get("input"),type(e).__name__,e),False,_cache_stats_delta(cache,before)
+    stats = _cache_stats_delta(cache,before)
+    return size,None,bool(stats and stats["hits"]),stats
+
+
+def convert_batch(entries,jobs=None,cache_dir=None):
+    """
+    converts all manifest entries in parallel
+    jobs: number of worker processes (None: one per cpu)
+    cache_dir: optional conversion cache directory, shared by all workers
+    returns a list of BatchResult, in the manifest order. Conversion errors
+    (BitplaneException, missing or invalid files, invalid entries) are reported
+    in the results instead of aborting the batch
+    """
+    cache_dirs = [cache_dir]*len(entries)
+    if jobs == 1:
+        results = map(_convert_entry_safe,entries,cache_dirs)
+        return [BatchResult(e.get("input"),e.get("output"),*r) for e,r in zip(entries,results)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(_convert_entry_safe,entries,cache_dirs,chunksize=max(1,len(entries)//(8*(jobs or os.cpu_count() or 1))))
+        return [BatchResult(e.get("input"),e.get("output"),*r) for e,r in zip(entries,results)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="converts a batch of images to amiga bitplanes/sprites/palettes")
+    parser.add_argument("manifest",help="json manifest file")
+    parser.add_argument("-j","--jobs",type=int,default=None,help="number of worker processes (default: one per cpu)")
+    parser.add_argument("--cache",default=None,help="conversion cache directory, unchanged images are not converted again")
+    args = parser.parse_args()
+
+    entries = load_manifest(args.manifest)
+
+    start = time.perf_counter()
+    results = convert_batch(entries,args.jobs,args.cache)
+    elapsed = max(time.perf_counter() - start,1e-6)
+
+    nb_errors = 0
+    nb_cached = 0
+    total_size = 0
+    cache_stats = collections.Counter()
+    for result in results:
+        nb_cached += result.cached
+        cache_stats.update(result.cache_stats or {})
+        if result.error:
+            nb_errors += 1
+            print("Error: {}".format(result.error))
+        else:
+            total_size += result.size
+            print("{} -> {} ({} bytes)".format(result.input,result.output,result.size))
+
+    print("{} images, {} errors in {:.2f}s: {:.1f} images/s, {:.2f} MB/s".format(
+        len(results),nb_errors,elapsed,len(results)/elapsed,total_size/elapsed/(1024*1024)))
+    if args.cache:
+        print("cache: {} conversions reused, {} hits, {} misses, {} evictions".format(
+            nb_cached,cache_stats["hits"],cache_stats["misses"],cache_stats["evictions"]))
+    return 1 if nb_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import hashlib,json,os,tempfile,time
+
+import bitplanelib
+
+# On-disk cache of palette_image2raw/palette_image2sprite outputs, keyed by a hash
+# of the input image bytes, the palette and all conversion parameters.
+# Entries are written to a temporary file then renamed, so several build processes
+# can share the same cache directory. Least recently used entries are evicted
+# when the cache grows over max_size.
+
+CACHE_SUFFIX = ".bin"
+TEMP_SUFFIX = ".tmp"
+# temporary files older than this (seconds) were left by crashed writers
+STALE_TEMP_AGE = 3600
+
+
+class ConversionCache():
+    def __init__(self, cache_dir, max_size=256*1024*1024):
+        """
+        cache_dir: directory holding the cache entries (created if needed)
+        max_size: maximum total size of the entries in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # total size of the entries, as of the last directory scan plus the entries stored since
+        # (other processes may have stored or evicted entries meanwhile)
+        self.size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def stats(self):
+        return {"hits":self.hits,"misses":self.misses,"evictions":self.evictions}
+
+    def key(self, function_name, input_image, palette, **params):
+        """
+        computes the cache key of a conversion
+        input_image: filename (file contents are hashed, the image isn't decoded) or PIL image
+        """
+        h = hashlib.sha256()
+        h.update(json.dumps([bitplanelib.__version__,function_name,
+                             [list(c) for c in palette],sorted(params.items())]).encode())
+        if isinstance(input_image,str):
+            with open(input_image,"rb") as f:
+                for block in iter(lambda: f.read(1<<20),b""):
+                    h.update(block)
+        else:
+            h.update(json.dumps([input_image.mode,input_image.size]).encode())
+            if input_image.mode == "P":
+                h.update(bytes(input_image.getpalette()))
+            h.update(input_image.tobytes())
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir,key+CACHE_SUFFIX)
+
+    def lookup(self, key):
+        """
+        returns the cached contents or None
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path,"rb") as f:
+                contents = f.read()
+            # mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            # not there, or evicted by another process meanwhile
+            self.misses += 1
+            return None
+        self.hits += 1
+        return contents
+
+    def _new_temp_path(self):
+        fd,temp_path = tempfile.mkstemp(dir=self.cache_dir,suffix=TEMP_SUFFIX)
+        os.close(fd)
+        return temp_path
+
+    def _commit(self, temp_path, key):
+        size = os.path.getsize(temp_path)
+        # atomic: other processes see either no entry or a complete one
+        os.replace(temp_path,self._entry_path(key))
+        # the directory is only scanned once, then when the tracked size goes over max_size
+        if self.size is None:
+            self.evict()
+        else:
+            self.size += size
+            if self.size > self.max_size:
+                self.evict()
+
+    def store(self, key, contents):
+        temp_path = self._new_temp_path()
+        try:
+            with open(temp_path,"wb") as f:
+                f.write(contents)
+            self._commit(temp_path,key)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def evict(self):
+        """
+        removes the least recently used entries until the cache fits in max_size,
+        and the temporary files left by crashed writers
+        """
+        entries = []
+        total_size = 0
+        stale_time = time.time()-STALE_TEMP_AGE
+        with os.scandir(self.cache_dir) as it:
+            for e in it:
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                if e.name.endswith(CACHE_SUFFIX):
+                    entries.append((st.st_mtime,st.st_size,e.path))
+                    total_size += st.st_size
+                elif e.name.endswith(TEMP_SUFFIX) and st.st_mtime < stale_time:
+                    try:
+                        os.remove(e.path)
+                    except FileNotFoundError:
+                        pass
+
+        entries.sort()
+        for _,size,path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                # already evicted by another process
+                pass
+            total_size -= size
+        self.size = total_size
+
+    def _convert(self, key, function, input_image, output_filename, *args, **kwargs):
+        """
+        returns the cached output file contents, running the conversion on a miss
+        """
+        contents = self.lookup(key)
+        if contents is None:
+            # let the conversion write its output file in the cache directory
+            temp_path = self._new_temp_path()
+            try:
+                function(input_image,temp_path,*args,**kwargs)
+                with open(temp_path,"rb") as f:
+                    contents = f.read()
+                self._commit(temp_path,key)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+
+        if output_filename:
+            with open(output_filename,"wb") as f:
+                f.write(contents)
+        return contents
+
+    def palette_image2raw(self,input_image,output_filename,palette,add_dimensions=False,forced_nb_planes=None,
+                    palette_precision_mask=0xFF,generate_mask=False,blit_pad=False,mask_color=(0,0,0),
+                    layout=bitplanelib.BITPLANE_LAYOUT_CONSECUTIVE):
+        """
+        cached version of bitplanelib.palette_image2raw
+        """
+        params = dict(add_dimensions=add_dimensions,forced_nb_planes=forced_nb_planes,
+                      palette_precision_mask=palette_precision_mask,generate_mask=generate_mask,
+                      blit_pad=blit_pad,mask_color=tuple(mask_color),
+                      layout=layout if isinstance(layout,str) else tuple(layout))
+        key = self.key("palette_image2raw",input_image,palette,**params)
+        contents = self._convert(key,bitplanelib.palette_image2raw,input_image,output_filename,palette,**params)
+        # returned data doesn't include the dimensions header
+        return contents[4:] if add_dimensions else contents
+
+    def palette_image2sprite(self,input_image,output_filename,palette,palette_precision_mask=0xFF,sprite_fmode=0):
+        """
+        cached version of bitplanelib.palette_image2sprite
+        """
+        params = dict(palette_precision_mask=palette_precision_mask,sprite_fmode=sprite_fmode)
+        key = self.key("palette_image2sprite",input_image,palette,**params)
+        return self._convert(key,bitplanelib.palette_image2sprite,input_image,output_filename,palette,**params)
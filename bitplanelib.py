@@ -1,10 +1,25 @@
-import PIL.Image,math,struct,json
+import PIL.Image,collections,math,struct,json
+import numpy as np
+
+__version__ = "1.1"
 
 PALETTE_FORMAT_ASMMOT = 1
 PALETTE_FORMAT_ASMGNU = 1<<1
 PALETTE_FORMAT_BINARY = 1<<2
 PALETTE_FORMAT_COPPERLIST = 1<<3
 PALETTE_FORMAT_PNG = 1<<4
+# command line/manifest names of the palette formats
+PALETTE_FORMATS = {"asmmot":PALETTE_FORMAT_ASMMOT,
+                   "asmgnu":PALETTE_FORMAT_ASMGNU,
+                   "binary":PALETTE_FORMAT_BINARY,
+                   "copperlist":PALETTE_FORMAT_COPPERLIST,
+                   "png":PALETTE_FORMAT_PNG}
+
+# bitplane layouts: whole planes one after the other, or one row of each plane in turn
+# (ILBM, blitter friendly). A custom layout is a (plane_offset,modulo) tuple: bytes between
+# the start of two planes, bytes skipped after each row
+BITPLANE_LAYOUT_CONSECUTIVE = "consecutive"
+BITPLANE_LAYOUT_INTERLEAVED = "interleaved"
 
 class BitplaneException(Exception):
     pass
@@ -16,6 +31,7 @@ def closest_color(c1,colorlist):
     returns: one of the colors of colorlist
 
     probably not the best algorithm but...
+    (to map whole images, see palette_build_lookup/palette_quantize_image)
     """
     closest = None
     min_dist = (255*255)*3
@@ -27,6 +43,101 @@ def closest_color(c1,colorlist):
             closest = c
     return closest
 
+# 4x4 bayer matrix for ordered dithering, thresholds in [-0.5,0.5[
+_BAYER4 = (np.array([[0,8,2,10],[12,4,14,6],[3,11,1,9],[15,7,13,5]],dtype=np.float32)+0.5)/16 - 0.5
+
+def palette_build_lookup(palette,bits_per_component=4):
+    """
+    builds a reusable nearest color lookup table for a palette
+    bits_per_component: 4: 4096 entries (RGB4, amiga ECS precision), 5: 32768 entries
+    returns a numpy array of palette indexes, indexed by the truncated RGB value
+    (see palette_quantize_image)
+
+    each truncated RGB value is mapped to the color closest to the center of its cell
+    (square distance in RGB, lowest color number wins on ties): the same as closest_color
+    for cell centers, pixels close to the boundary between two colors may get the other one
+    """
+    levels = 1 << bits_per_component
+    step = 256 // levels
+    # compare palette to the center of each RGB cell
+    values = np.arange(levels,dtype=np.int32)*step + step//2
+    grid = np.stack(np.meshgrid(values,values,values,indexing="ij"),axis=-1).reshape(-1,1,3)
+    pal = np.array([tuple(c)[:3] for c in palette],dtype=np.int32).reshape(1,-1,3)
+    dist = ((grid - pal)**2).sum(axis=2)
+    return np.argmin(dist,axis=1).astype(np.uint8 if len(palette) <= 256 else np.uint16)
+
+def _lookup_bits(lookup):
+    return (len(lookup).bit_length()-1)//3
+
+def _lookup_rgb(rgb,lookup):
+    """
+    rgb: (...,3) array of 0-255 values
+    """
+    bits = _lookup_bits(lookup)
+    shift = 8-bits
+    rgb = rgb.astype(np.int32) >> shift
+    return lookup[(rgb[...,0] << (2*bits)) | (rgb[...,1] << bits) | rgb[...,2]]
+
+def _floyd_steinberg(rgb,palette,lookup):
+    """
+    error diffusion is sequential by nature, but a pixel only depends on its left neighbour
+    and on the 3 pixels above it: all the pixels of a x+2*y "wavefront" are independent, and
+    processed at once (width+2*height numpy steps). The errors are summed in the same order
+    as a row by row scan, so the result is the same
+    """
+    height,width,_ = rgb.shape
+    bits = _lookup_bits(lookup)
+    shift = 8-bits
+    pal = np.array([tuple(c)[:3] for c in palette],dtype=np.float64)
+    indexes = np.empty((height,width),dtype=lookup.dtype)
+
+    current = rgb.astype(np.float64)
+    # errors from the row above (columns shifted by 1, extra row and columns catch the errors
+    # going out of the image) and from the left pixel
+    below = np.zeros((height+1,width+2,3))
+    right = np.zeros((height,width+1,3))
+    for t in range(width+2*(height-1)):
+        ys = np.arange(max(0,(t-width+2)//2),min(height-1,t//2)+1)
+        xs = t-2*ys
+        value = (current[ys,xs]+below[ys,xs+1])+right[ys,xs]
+        rgb_bits = np.clip(np.trunc(value),0,255).astype(np.int32) >> shift
+        index = lookup[(rgb_bits[:,0] << (2*bits)) | (rgb_bits[:,1] << bits) | rgb_bits[:,2]]
+        indexes[ys,xs] = index
+        err = value-pal[index]
+        right[ys,xs+1] = err*7/16
+        below[ys+1,xs+2] += err/16
+        below[ys+1,xs] += err*3/16
+        below[ys+1,xs+1] += err*5/16
+    return indexes
+
+def palette_quantize_image(input_image,palette,lookup=None,dither=None,dither_strength=32):
+    """
+    maps an image (any number of colors) to the nearest palette indexes
+    lookup: table from palette_build_lookup, to reuse between images. If None, a RGB4 table is built
+    dither: None, "ordered" (4x4 bayer matrix) or "floyd-steinberg"
+    dither_strength: amplitude of the ordered dithering, in RGB units
+    returns a (height,width) numpy array of palette indexes, that can be
+    converted to bitplanes by bitplanes_indexes2raw
+    """
+    if isinstance(input_image,str):
+        imgorg = PIL.Image.open(input_image)
+    else:
+        imgorg = input_image
+    if lookup is None:
+        lookup = palette_build_lookup(palette)
+
+    rgb = np.asarray(imgorg.convert("RGB"))
+    if dither is None:
+        return _lookup_rgb(rgb,lookup)
+    elif dither == "ordered":
+        height,width,_ = rgb.shape
+        threshold = np.tile(_BAYER4,(height//4+1,width//4+1))[:height,:width,np.newaxis]
+        return _lookup_rgb(np.clip(rgb + threshold*dither_strength,0,255),lookup)
+    elif dither == "floyd-steinberg":
+        return _floyd_steinberg(rgb,palette,lookup)
+    else:
+        raise BitplaneException("Unknown dither mode {}".format(dither))
+
 def dump_asm_bytes(block,f,mit_format=False,nb_elements_per_row=8,size=1):
     c = 0
     hs = "0x" if mit_format else "$"
@@ -48,58 +159,158 @@ def palette_load_from_json(filename):
         p = [tuple(x) for x in json.load(f)]
     return p
 
-def bitplanes_colors_used(contents,nb_planes,width,height):
+def bitplanes_colors_used(contents,nb_planes,width,height,layout=BITPLANE_LAYOUT_CONSECUTIVE):
     """
     analyzes a ripped planar image
     height : -1: autocompute from contents size & width & nb planes
     returns a set of palette indexes
     """
+    return bitplanes_statistics(contents,nb_planes,width,height,layout)["colors_used"]
+
+def bitplanes_statistics(contents,nb_planes,width,height,layout=BITPLANE_LAYOUT_CONSECUTIVE):
+    """
+    analyzes a ripped planar image
+    contents: bytes, or memoryview/mmap to avoid copying large dumps
+    height : -1: autocompute from contents size & width & nb planes
+    layout: BITPLANE_LAYOUT_CONSECUTIVE, BITPLANE_LAYOUT_INTERLEAVED or (plane_offset,modulo)
+    returns a dict with:
+    - colors_used: set of palette indexes
+    - histogram: number of pixels for each palette index (list of 1<<nb_planes values)
+    - plane_population: number of set bits of each plane
+    - constant_planes: {plane: 0 or 1} for planes with all bits clear or all set
+    """
     if height < 0:
-        height = (len(contents)//(width*nb_planes))*8
+        height = _layout_height(len(contents),layout,nb_planes,width)
 
+    indexes = _planes_to_indexes(contents,nb_planes,width,height,layout)
+    histogram = np.bincount(indexes.ravel(),minlength=1<<nb_planes)
+    nb_pixels = width*height
 
-    plane_size = (width//8)*height
-    rval = set()
+    all_indexes = np.arange(len(histogram))
+    plane_population = [int(histogram[(all_indexes >> p) & 1 == 1].sum()) for p in range(nb_planes)]
+    constant_planes = {p:int(pop == nb_pixels) for p,pop in enumerate(plane_population) if pop in (0,nb_pixels)}
 
-    for y in range(height):
-        for x in range(0,width,8):
-            offset = (y*width + x)//8
-            for i in range(8):
-                value = 0
-                shift = (1<<(7-i))
+    return {"colors_used":set(np.flatnonzero(histogram).tolist()),
+            "histogram":histogram.tolist(),
+            "plane_population":plane_population,
+            "constant_planes":constant_planes}
 
-                for p in range(nb_planes):
-                    if (shift & contents[p*plane_size + offset]):
-                        value |= 1<<p
+def _as_uint8_array(contents):
+    """
+    returns a numpy uint8 view of contents (bytes, bytearray, memoryview, mmap...)
+    without copying when possible
+    """
+    if isinstance(contents,np.ndarray):
+        return contents.astype(np.uint8,copy=False).ravel()
+    try:
+        return np.frombuffer(contents,dtype=np.uint8)
+    except TypeError:
+        # list of ints or other iterable
+        return np.asarray(contents,dtype=np.uint8)
 
-                rval.add(value)
-    return rval
+def _layout_strides(layout,nb_planes,row_size,height):
+    """
+    returns (plane_stride,row_stride) of a bitplane layout, in bytes
+    """
+    if layout == BITPLANE_LAYOUT_CONSECUTIVE:
+        return row_size*height,row_size
+    elif layout == BITPLANE_LAYOUT_INTERLEAVED:
+        return row_size,row_size*nb_planes
+    try:
+        plane_offset,modulo = layout
+    except (TypeError,ValueError):
+        raise BitplaneException("Unknown bitplane layout {}".format(layout))
+    return plane_offset,row_size+modulo
+
+def _layout_height(size,layout,nb_planes,width):
+    """
+    number of rows fitting in size bytes (height -1 autocompute)
+    """
+    if layout in (BITPLANE_LAYOUT_CONSECUTIVE,BITPLANE_LAYOUT_INTERLEAVED):
+        return (size//(width*nb_planes))*8
+    row_size = width//8
+    plane_stride,row_stride = _layout_strides(layout,nb_planes,row_size,0)
+    return max(0,(size-(nb_planes-1)*plane_stride-row_size)//row_stride+1)
 
-def bitplanes_raw2image(contents,nb_planes,width,height,output_filename,palette):
+def _layout_planes(data,nb_planes,height,row_size,layout):
+    """
+    (nb_planes,height,row_size) strided view of the bitplanes in a 1D uint8 array
+    """
+    plane_stride,row_stride = _layout_strides(layout,nb_planes,row_size,height)
+    if nb_planes and height and row_size:
+        needed = (nb_planes-1)*plane_stride+(height-1)*row_stride+row_size
+        if len(data) < needed:
+            raise BitplaneException("Not enough data: {} bytes, {} needed".format(len(data),needed))
+    return np.lib.stride_tricks.as_strided(data,(nb_planes,height,row_size),(plane_stride,row_stride,1),writeable=False)
+
+def _planes_to_indexes(contents,nb_planes,width,height,layout=BITPLANE_LAYOUT_CONSECUTIVE):
+    """
+    unpacks bitplanes into a (height,width) array of palette indexes
+    (uint8, uint16 or uint32 depending on the number of planes, 32 at most)
+    """
+    if nb_planes > 32:
+        raise BitplaneException("Unsupported number of planes {}, 32 at most".format(nb_planes))
+    data = np.ascontiguousarray(_as_uint8_array(contents))
+    planes = np.unpackbits(_layout_planes(data,nb_planes,height,width//8,layout),axis=2)
+    indexes = np.zeros((height,width),dtype=np.uint8 if nb_planes <= 8 else np.uint16 if nb_planes <= 16 else np.uint32)
+    for p in range(nb_planes):
+        indexes |= planes[p].astype(indexes.dtype) << p
+    return indexes
+
+def _indexes_to_planes(indexes,nb_planes):
+    """
+    packs a (height,width) array of palette indexes into an array of
+    consecutive bitplanes, shape (nb_planes,height,width//8)
+    """
+    return np.stack([np.packbits((indexes >> p) & 1,axis=1) for p in range(nb_planes)])
+
+def _planes_to_raw(planes,layout=BITPLANE_LAYOUT_CONSECUTIVE):
+    """
+    lays out a (nb_planes,height,row_size) array of bitplanes, returns bytes
+    (bytes skipped by custom layouts are zero)
+    """
+    nb_planes,height,row_size = planes.shape
+    plane_stride,row_stride = _layout_strides(layout,nb_planes,row_size,height)
+    size = (nb_planes-1)*plane_stride+(height-1)*row_stride+row_size if nb_planes and height else 0
+    out = np.zeros(max(size,0),dtype=np.uint8)
+    np.lib.stride_tricks.as_strided(out,planes.shape,(plane_stride,row_stride,1))[...] = planes
+    return out.tobytes()
+
+def _rgb_to_indexes(rgb,palette,palette_precision_mask=0xFF):
+    """
+    maps a (height,width,3) RGB array to palette indexes, comparing
+    masked pixels to the palette colors, with a privilege of the lowest color
+    numbers where there are duplicates (example: EHB emulated palette)
+    returns (indexes,found) arrays, indexes are 0 where found is False
+    """
+    rgb = rgb[...,:3] & np.uint8(palette_precision_mask)
+    keys = ((rgb[...,0].astype(np.uint32) << 16) | (rgb[...,1].astype(np.uint32) << 8) | rgb[...,2])
+
+    # packed 24-bit keys of the palette, sorted for lookup, first index wins
+    key_to_index = {}
+    for i,c in enumerate(palette):
+        key_to_index.setdefault((c[0] << 16) | (c[1] << 8) | c[2],i)
+    palette_keys = np.array(sorted(key_to_index),dtype=np.uint32)
+    palette_indexes = np.array([key_to_index[k] for k in palette_keys.tolist()],dtype=np.uint16)
+
+    pos = np.minimum(np.searchsorted(palette_keys,keys),len(palette_keys)-1)
+    found = palette_keys[pos] == keys
+    indexes = np.where(found,palette_indexes[pos],0).astype(np.uint16)
+    return indexes,found
+
+def bitplanes_raw2image(contents,nb_planes,width,height,output_filename,palette,layout=BITPLANE_LAYOUT_CONSECUTIVE):
     """
     converts a ripped planar image + palette to png
     height : -1: autocompute from contents size & width & nb planes
+    layout: BITPLANE_LAYOUT_CONSECUTIVE, BITPLANE_LAYOUT_INTERLEAVED or (plane_offset,modulo)
     """
     if height < 0:
-        height = (len(contents)//(width*nb_planes))*8
+        height = _layout_height(len(contents),layout,nb_planes,width)
 
-    img = PIL.Image.new('RGB', (width,height))
-
-
-    plane_size = (width//8)*height
-
-    for y in range(height):
-        for x in range(0,width,8):
-            offset = (y*width + x)//8
-            for i in range(8):
-                value = 0
-                shift = (1<<(7-i))
-
-                for p in range(nb_planes):
-                    if (shift & contents[p*plane_size + offset]):
-                        value |= 1<<p
-
-                img.putpixel((x+i,y),palette[value])
+    indexes = _planes_to_indexes(contents,nb_planes,width,height,layout)
+    # one lookup in the palette for all pixels
+    lut = np.array([tuple(c)[:3] for c in palette],dtype=np.uint8)
+    img = PIL.Image.fromarray(lut[indexes])
 
     if output_filename:
         img.save(output_filename)
@@ -231,7 +442,7 @@ def __palette_dump(palette,f,pformat,low_nibble):
             if colmod == 0 and aga:
                 # issue bank
                 params = (0x106,(bank<<13))
-                if as_binary:
+                if pformat & PALETTE_FORMAT_BINARY:
                     f.write(struct.pack(">HH",*params))
                 else:
                     f.write("{3}{0:x},{3}{1:x}\n\t{2}\t".format(params[0],params[1],dcw,hexs))
@@ -291,11 +502,13 @@ def palette_dump(palette,output,pformat=PALETTE_FORMAT_ASMMOT,high_precision=Fal
         if isinstance(output,str):
             f.close()
 
-def palette_extract(input_image,palette_precision_mask=0xFF):
+def palette_extract(input_image,palette_precision_mask=0xFF,with_counts=False,max_colors=None):
     """
     extract the palette of an image
     palette_precision_mask: 0xFF: full RGB range, 0xF0: amiga ECS palette
     sort palette (order isn't preserved in pngs anyway) so black is first
+    with_counts: if True, returns a list of (rgb,number of pixels) instead
+    max_colors: if not None, raise BitplaneException as soon as more colors are found
     """
     if isinstance(input_image,str):
         imgorg = PIL.Image.open(input_image)
@@ -307,14 +520,35 @@ def palette_extract(input_image,palette_precision_mask=0xFF):
     img = PIL.Image.new('RGB', (width,height))
     img.paste(imgorg, (0,0))
 
-    # count same colors
-    rval = set()
-    for y in range(height):
-        for x in range(width):
-            p = img.getpixel((x,y))
+    def too_many_colors():
+        return BitplaneException("{}: more than {} colors found".format(input_image,max_colors))
+
+    colors = None
+    if max_colors is not None:
+        # PIL stops counting when there are too many colors: fail fast
+        # without masking, else quick path for the (usual) small number of colors
+        colors = img.getcolors(max_colors)
+        if colors is None and palette_precision_mask == 0xFF:
+            raise too_many_colors()
+
+    if colors is not None:
+        counts = {}
+        for count,p in colors:
             p = tuple(x & palette_precision_mask for x in p)
-            rval.add(p)
-    return sorted(rval)
+            counts[p] = counts.get(p,0) + count
+        rval = sorted(counts.items())
+    else:
+        # count same colors, using packed 24-bit keys (sorted like RGB tuples)
+        rgb = np.asarray(img) & np.uint8(palette_precision_mask)
+        keys = (rgb[...,0].astype(np.uint32) << 16) | (rgb[...,1].astype(np.uint32) << 8) | rgb[...,2]
+        keys,counts = np.unique(keys,return_counts=True)
+        if max_colors is not None and len(keys) > max_colors:
+            raise too_many_colors()
+        rval = [(((k >> 16),(k >> 8) & 0xFF,k & 0xFF),c) for k,c in zip(keys.tolist(),counts.tolist())]
+
+    if with_counts:
+        return rval
+    return [p for p,_ in rval]
 
 def palette_round(palette,mask=0xF0):
     """
@@ -351,17 +585,90 @@ def palette_fromjascpalette(infile,rgb_mask=0xFF):
 
 
 
+def bitplanes_raw2indexes(contents,nb_planes,width,height,layout=BITPLANE_LAYOUT_CONSECUTIVE):
+    """ converts a ripped planar image to a (height,width) numpy array of palette indexes,
+    to apply several palettes without decoding the bitplanes again
+    contents: bytes, or memoryview/mmap to avoid copying large dumps
+    height : -1: autocompute from contents size & width & nb planes
+    layout: BITPLANE_LAYOUT_CONSECUTIVE, BITPLANE_LAYOUT_INTERLEAVED or (plane_offset,modulo)
+    """
+    if width % 8:
+        raise BitplaneException("width must be a multiple of 8, found {}".format(width))
+    if height < 0:
+        height = _layout_height(len(contents),layout,nb_planes,width)
+    return _planes_to_indexes(contents,nb_planes,width,height,layout)
+
+def bitplanes_indexes2raw(indexes,nb_planes,output_filename=None,layout=BITPLANE_LAYOUT_CONSECUTIVE):
+    """ converts a (height,width) array of palette indexes (as returned by
+    palette_quantize_image) to raw bitplanes
+    layout: BITPLANE_LAYOUT_CONSECUTIVE, BITPLANE_LAYOUT_INTERLEAVED or (plane_offset,modulo)
+    if output_filename is not None, then save as file. Else just return created data
+    """
+    indexes = np.asarray(indexes)
+    if indexes.shape[1] % 8:
+        raise BitplaneException("width must be a multiple of 8, found {}".format(indexes.shape[1]))
+    out = _planes_to_raw(_indexes_to_planes(indexes,nb_planes),layout)
+    if output_filename:
+        with open(output_filename,"wb") as f:
+            f.write(out)
+    return out
+
+def _nb_planes(palette,forced_nb_planes=None):
+    """
+    number of planes is automatically converted from palette size
+    """
+    min_nb_planes = int(math.ceil(math.log2(len(palette))))
+    if forced_nb_planes:
+        if min_nb_planes > forced_nb_planes:
+            raise BitplaneException("Minimum number of planes is {}, forced to {} (nb colors = {})".format(min_nb_planes,forced_nb_planes,len(palette)))
+        return forced_nb_planes
+    return min_nb_planes
+
+def _palette_image_indexes(input_image,rgb,palette,palette_precision_mask,mask_color):
+    """
+    palette indexes of a (height,width,3) RGB array, all pixels must match a palette color
+    except the ones of mask color (None: no mask color), which are left as 0
+    returns (indexes,not_masked) arrays
+    """
+    def html(p):
+        return ("{:02x}"*3).format(*p)
+
+    if mask_color is None:
+        not_masked = np.ones(rgb.shape[:2],dtype=bool)
+    else:
+        not_masked = np.any(rgb != np.array(mask_color[:3],dtype=np.uint8),axis=2)
+    indexes,found = _rgb_to_indexes(rgb,palette,palette_precision_mask)
+
+    not_found = not_masked & ~found
+    if not_found.any():
+        # only report the first offending pixel, in scan order
+        y,x = divmod(int(np.argmax(not_found)),rgb.shape[1])
+        porg = tuple(int(v) for v in rgb[y,x])
+        p = tuple(x & palette_precision_mask for x in porg)
+        # try to suggest close colors (lowest color numbers come last, like in a palette dict)
+        approx = tuple(x&0xFE for x in p)
+        close_colors = [c for c in dict.fromkeys(reversed(palette)) if tuple(x&0xFE for x in c)==approx]
+
+        msg = "{}: (x={},y={}) rounded color {} (#{}) not found, orig color {} (#{}), maybe try adjusting precision mask".format(
+    input_image,x,y,p,html(p),porg,html(porg))
+        msg += " {} close colors: {}".format(len(close_colors),close_colors)
+        raise BitplaneException(msg)
+
+    indexes[~not_masked] = 0
+    return indexes,not_masked
+
 def palette_image2raw(input_image,output_filename,palette,add_dimensions=False,forced_nb_planes=None,
-                    palette_precision_mask=0xFF,generate_mask=False,blit_pad=False,mask_color=(0,0,0)):
+                    palette_precision_mask=0xFF,generate_mask=False,blit_pad=False,mask_color=(0,0,0),
+                    layout=BITPLANE_LAYOUT_CONSECUTIVE):
     """ rebuild raw bitplanes with palette (ordered) and any image which has
     the proper number of colors and color match
     pass None as output_filename to avoid writing to file
     returns image raw data
     palette_precision_mask: 0xFF: no mask, full precision when looking up the colors, 0xF0: ECS palette mask, or custom
+    mask_color: pixels of this color are set to color 0 (None: all pixels are looked up in the palette)
+    layout: BITPLANE_LAYOUT_CONSECUTIVE, BITPLANE_LAYOUT_INTERLEAVED or (plane_offset,modulo).
+    The mask plane, if generated, is laid out as one more plane
     """
-    # quick palette index lookup, with a privilege of the lowest color numbers
-    # where there are duplicates (example: EHB emulated palette)
-    palette_dict = {p:i for i,p in reversed(list(enumerate(palette)))}
     if isinstance(input_image,str):
         imgorg = PIL.Image.open(input_image)
     else:
@@ -374,62 +681,20 @@ def palette_image2raw(input_image,output_filename,palette,add_dimensions=False,f
         if r:
             width += 16-r
         width += 16
-    img = PIL.Image.new('RGB', (width,height), mask_color if generate_mask else 0)
+    img = PIL.Image.new('RGB', (width,height), mask_color if generate_mask and mask_color is not None else 0)
     img.paste(imgorg, (0,0))
 
     if width % 8:
         raise BitplaneException("{} width must be a multiple of 8, found {}".format(input_image,width))
 
-
-    # number of planes is automatically converted from palette size
-    min_nb_planes = int(math.ceil(math.log2(len(palette))))
-    if forced_nb_planes:
-        if min_nb_planes > forced_nb_planes:
-            raise BitplaneException("Minimum number of planes is {}, forced to {} (nb colors = {})".format(min_nb_planes,forced_nb_planes,len(palette)))
-        nb_planes = forced_nb_planes
-    else:
-        nb_planes = min_nb_planes
-
-    def html(p):
-        return ("{:02x}"*3).format(*p)
-    plane_size = height*width//8
-
-    actual_nb_planes = nb_planes
+    nb_planes = _nb_planes(palette,forced_nb_planes)
+    indexes,not_masked = _palette_image_indexes(input_image,np.asarray(img),palette,palette_precision_mask,mask_color)
+    planes = _indexes_to_planes(indexes,nb_planes)
     if generate_mask:
-        actual_nb_planes+=1
-
-    out = [0]*(actual_nb_planes*plane_size)
-    for y in range(height):
-        for xb in range(0,width,8):
-            for i in range(8):
-                x = xb+i
-                bitset = (1<<(7-i))
-                offset = (y*width + x)//8
-                porg = img.getpixel((x,y))
-                if porg != mask_color:
-                    if generate_mask:
-                        # any non-mask color: set bit in mask
-                        out[nb_planes*plane_size + offset] |= bitset
-
-                    p = tuple(x & palette_precision_mask for x in porg)
-                    try:
-                        color_index = palette_dict[p]
-                    except KeyError:
-                        # try to suggest close colors
-                        approx = tuple(x&0xFE for x in p)
-                        close_colors = [c for c in palette_dict if tuple(x&0xFE for x in c)==approx]
-
-                        msg = "{}: (x={},y={}) rounded color {} (#{}) not found, orig color {} (#{}), maybe try adjusting precision mask".format(
-                    input_image,x,y,p,html(p),porg,html(porg))
-                        msg += " {} close colors: {}".format(len(close_colors),close_colors)
-                        raise BitplaneException(msg)
-
-                    for pindex in range(nb_planes):
-                        if color_index & (1<<pindex):
-                            out[pindex*plane_size + offset] |= bitset
+        # any non-mask color: set bit in mask
+        planes = np.concatenate((planes,np.packbits(not_masked,axis=1)[np.newaxis]))
 
-
-    out = bytes(out)
+    out = _planes_to_raw(planes,layout)
 
     if output_filename:
         with open(output_filename,"wb") as f:
@@ -440,6 +705,124 @@ def palette_image2raw(input_image,output_filename,palette,add_dimensions=False,f
     return out
 
 
+TILE_FLIP_X = 1
+TILE_FLIP_Y = 2
+
+TileSet = collections.namedtuple("TileSet","tiles tilemap nb_tiles")
+
+def _tile_keys(tiles,nb_planes):
+    """
+    planar bytes of each tile of a (nb_tiles,height,width) index array, as one row per tile
+    """
+    if nb_planes <= 8:
+        tiles = np.ascontiguousarray(tiles,dtype=np.uint8)
+    nb_tiles,height,width = tiles.shape
+    # rows are whole bytes: packing the flattened bits is the same, and much faster than along an axis
+    planes = np.stack([np.packbits(((tiles >> p) & 1).ravel()).reshape(nb_tiles,height,width//8) for p in range(nb_planes)],axis=1)
+    rows = np.ascontiguousarray(planes.reshape(nb_tiles,-1))
+    # rows seen as single values, to be sorted and compared at once
+    return rows.view(np.dtype((np.void,rows.shape[1]))).ravel()
+
+def _first_occurrence_ids(keys):
+    """
+    numbers of the distinct keys, in order of first occurrence
+    returns (ids,first) arrays: id of each key, position of the first key of each id
+    """
+    _,first,inverse = np.unique(keys,return_index=True,return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return rank[inverse.ravel()],first[order]
+
+def palette_image2tiles(input_image,tiles_filename,tilemap_filename,palette,tile_size=(16,16),flips=False,
+                        tilemap_word=True,forced_nb_planes=None,palette_precision_mask=0xFF,mask_color=(0,0,0),
+                        layout=BITPLANE_LAYOUT_CONSECUTIVE):
+    """ cuts an image which has the proper number of colors and color match (see palette_image2raw)
+    into tiles, and stores identical tiles once
+    tile_size: (width,height), width must be a multiple of 8, the image size a multiple of the tile size
+    flips: if True, tiles identical to a stored tile flipped horizontally and/or vertically aren't stored,
+    the tilemap entry has TILE_FLIP_X/TILE_FLIP_Y set in its upper 2 bits
+    tilemap_word: big endian word tilemap entries, else byte entries
+    layout: bitplane layout of the tileset, a tile_width wide bitmap with the tiles stacked vertically
+    (with BITPLANE_LAYOUT_INTERLEAVED, each tile is a contiguous block)
+    pass None as tiles_filename/tilemap_filename to avoid writing to files
+    returns a TileSet: tiles (raw bitplanes), tilemap ((rows,columns) numpy array of entries), nb_tiles
+    """
+    if isinstance(input_image,str):
+        imgorg = PIL.Image.open(input_image)
+    else:
+        imgorg = input_image
+    width,height = imgorg.size
+    tile_width,tile_height = tile_size
+    if tile_width % 8:
+        raise BitplaneException("tile width must be a multiple of 8, found {}".format(tile_width))
+    if width % tile_width or height % tile_height:
+        raise BitplaneException("{} size {}x{} must be a multiple of the tile size {}x{}".format(
+            input_image,width,height,tile_width,tile_height))
+
+    nb_planes = _nb_planes(palette,forced_nb_planes)
+    indexes,_ = _palette_image_indexes(input_image,np.asarray(imgorg.convert("RGB")),palette,palette_precision_mask,mask_color)
+    rows,columns = height//tile_height,width//tile_width
+    tiles = indexes.reshape(rows,tile_height,columns,tile_width).transpose(0,2,1,3).reshape(-1,tile_height,tile_width)
+
+    if flips:
+        # variants: as is, flipped on x, on y, on both (TILE_FLIP_X|TILE_FLIP_Y)
+        variants = [tiles,tiles[:,:,::-1],tiles[:,::-1,:],tiles[:,::-1,::-1]]
+        _,variant_ids = np.unique(np.stack([_tile_keys(v,nb_planes) for v in variants],axis=1),return_inverse=True)
+        variant_ids = variant_ids.reshape(len(tiles),4)
+        # tiles which are flipped versions of each other share the same smallest variant
+        canonical_flip = np.argmin(variant_ids,axis=1)
+        ids,first = _first_occurrence_ids(variant_ids[np.arange(len(tiles)),canonical_flip])
+        # the first occurrence is stored as is, flips compose as a xor of the flip bits
+        tile_flips = canonical_flip ^ canonical_flip[first][ids]
+    else:
+        ids,first = _first_occurrence_ids(_tile_keys(tiles,nb_planes))
+        tile_flips = np.zeros(len(tiles),dtype=np.int64)
+
+    entry_bits = 16 if tilemap_word else 8
+    max_tiles = 1 << (entry_bits-2 if flips else entry_bits)
+    if len(first) > max_tiles:
+        raise BitplaneException("{}: {} tiles, only {} fit in the tilemap entries".format(input_image,len(first),max_tiles))
+    entries = ids | (tile_flips << (entry_bits-2))
+    tilemap = entries.reshape(rows,columns).astype(">u2" if tilemap_word else np.uint8)
+
+    out = bitplanes_indexes2raw(tiles[first].reshape(-1,tile_width),nb_planes,layout=layout)
+
+    if tiles_filename:
+        with open(tiles_filename,"wb") as f:
+            f.write(out)
+    if tilemap_filename:
+        with open(tilemap_filename,"wb") as f:
+            f.write(tilemap.tobytes())
+
+    return TileSet(out,tilemap,len(first))
+
+SPRITE_WIDTHS = {0:16,1:32,2:32,3:64}
+
+SpriteSheet = collections.namedtuple("SpriteSheet","data offsets nb_sprites")
+
+def _sprite_indexes(input_image,rgb,palette,palette_precision_mask,check=None):
+    """
+    palette indexes of a sprite (or sprite sheet) RGB array
+    check: optional boolean mask of the pixels which must match a palette color (default: all)
+    """
+    indexes,found = _rgb_to_indexes(rgb,palette,palette_precision_mask)
+    not_found = ~found if check is None else check & ~found
+    if not_found.any():
+        # only report the first offending pixel, in scan order
+        y,x = divmod(int(np.argmax(not_found)),rgb.shape[1])
+        porg = tuple(int(v) for v in rgb[y,x])
+        p = tuple(x & palette_precision_mask for x in porg)
+        # try to suggest close colors
+        approx = tuple(x&0xFE for x in p)
+        close_colors = [c for c in dict.fromkeys(reversed(palette)) if tuple(x&0xFE for x in c)==approx]
+
+        msg = "{}: (x={},y={}) rounded color {} not found, orig color {}, maybe try adjusting precision mask (current: 0x{:x})".format(
+    input_image,x,y,p,porg,palette_precision_mask)
+        msg += " {} close colors: {}".format(len(close_colors),close_colors)
+        raise BitplaneException(msg)
+    return indexes
+
 def palette_image2sprite(input_image,output_filename,palette,palette_precision_mask=0xFF,sprite_fmode=0):
     """ rebuild raw bitplanes with palette (ordered) and any image which has
     the proper number of colors and color match
@@ -447,51 +830,27 @@ def palette_image2sprite(input_image,output_filename,palette,palette_precision_m
     returns image raw data
     palette_precision_mask: 0xFF: no mask, full precision when looking up the colors, 0xF0: ECS palette mask, or custom
     sprite_fmode = 0 for OCS/ECS (16-bit wide), 1 & 2 (32-bit wide, unsupported), 3 (64-bit wide)
+    (to convert many frames at once, with control words, see palette_image2spritesheet)
     """
     if len(palette) != 4:
         raise BitplaneException("Palette size must be 4")
-    # quick palette index lookup, with a privilege of the lowest color numbers
-    # where there are duplicates (example: EHB emulated palette)
-    palette_dict = {p:i for i,p in reversed(list(enumerate(palette)))}
     if isinstance(input_image,str):
         imgorg = PIL.Image.open(input_image)
     else:
         imgorg = input_image
     # image could be paletted already. But we cannot trust palette order anyway
     img_width,height = imgorg.size
-    width = {0:16,1:32,2:32,3:64}[sprite_fmode]
+    width = SPRITE_WIDTHS[sprite_fmode]
     if img_width > width:
         raise BitplaneException("{} width must be <= {}, found {}".format(input_image,width,img_width))
     # convert to RGB and pad width if needed (16 bit wide sprite will be 64 bit wide in fmode=3)
     img = PIL.Image.new('RGB', (width,height),palette[0])
     img.paste(imgorg, (0,0))
-    nb_planes = 2
-
-    plane_size = height*width//8
-    out = [0]*(nb_planes*plane_size)
-    for y in range(height):
-        for x in range(0,width,8):
-            for i in range(8):
-                porg = img.getpixel((x+i,y))
-
-                p = tuple(x & palette_precision_mask for x in porg)
-                try:
-                    color_index = palette_dict[p]
-                except KeyError:
-                    # try to suggest close colors
-                    approx = tuple(x&0xFE for x in p)
-                    close_colors = [c for c in palette_dict if tuple(x&0xFE for x in c)==approx]
-
-                    msg = "{}: (x={},y={}) rounded color {} not found, orig color {}, maybe try adjusting precision mask (current: 0x{:x})".format(
-                input_image,x+i,y,p,porg,palette_precision_mask)
-                    msg += " {} close colors: {}".format(len(close_colors),close_colors)
-                    raise BitplaneException(msg)
-
-                for pindex in range(nb_planes):
-                    if color_index & (1<<pindex):
-                        out[(((y*nb_planes)+pindex)*width + x)//8] |= (1<<(7-i))
 
-    out = bytes(out)
+    # lowest color numbers win where there are duplicates (example: EHB emulated palette)
+    indexes = _sprite_indexes(input_image,np.asarray(img),palette,palette_precision_mask)
+    # both planes of each row follow each other
+    out = bitplanes_indexes2raw(indexes,2,layout=BITPLANE_LAYOUT_INTERLEAVED)
 
     if output_filename:
         with open(output_filename,"wb") as f:
@@ -499,6 +858,118 @@ def palette_image2sprite(input_image,output_filename,palette,palette_precision_m
 
     return out
 
+def _sprite_control_words(height,fetch_size,attached,position):
+    """
+    SPRxPOS/SPRxCTL, each one in its own fetch (padded to 32/64 bits with fmode 1, 2 & 3)
+    """
+    hstart,vstart = position
+    vstop = vstart+height
+    pos = ((vstart & 0xFF) << 8) | ((hstart >> 1) & 0xFF)
+    ctl = ((vstop & 0xFF) << 8) | (attached << 7) | (((vstart >> 8) & 1) << 2) | (((vstop >> 8) & 1) << 1) | (hstart & 1)
+    pad = bytes(fetch_size-2)
+    return struct.pack(">H",pos)+pad+struct.pack(">H",ctl)+pad
+
+def _sprite_blocks(frames,first_plane,fetch_size,attached,position):
+    """
+    frames: (nb_frames,height,width) array of palette indexes
+    returns the sprite of each frame (control words, interleaved planes, terminator), as bytes
+    """
+    nb_frames,height,_ = frames.shape
+    planes = [np.packbits((frames >> p) & 1,axis=2) for p in (first_plane,first_plane+1)]
+    lines = np.stack(planes,axis=2).reshape(nb_frames,-1)
+    header = _sprite_control_words(height,fetch_size,attached,position)
+    terminator = bytes(2*fetch_size)
+    return [header+line.tobytes()+terminator for line in lines]
+
+def spritesheet_grid(sheet_size,frame_size,nb_frames=None):
+    """
+    boxes (x,y,width,height) of the frames of a sprite sheet laid out as a grid, row by row
+    """
+    sheet_width,sheet_height = sheet_size
+    frame_width,frame_height = frame_size
+    boxes = [(x,y,frame_width,frame_height) for y in range(0,sheet_height-frame_height+1,frame_height)
+             for x in range(0,sheet_width-frame_width+1,frame_width)]
+    return boxes[:nb_frames]
+
+def palette_image2spritesheet(input_image,output_filename,palette,frame_size=None,frames=None,
+                              palette_precision_mask=0xFF,sprite_fmode=0,position=(0,0),with_table=True):
+    """ converts all the frames of a sprite sheet to hardware sprites, with control words
+    and terminator, identical frames being stored once
+    frame_size: (width,height) of the frames of a grid sheet, or
+    frames: list of (x,y,width,height) boxes (atlas), in the output order
+    palette: 4 colors, or 16 colors for attached sprite pairs (the even sprite holds planes 0 & 1,
+    the odd one, with the attach bit set, follows it and holds planes 2 & 3)
+    sprite_fmode = 0 for OCS/ECS (16-bit wide), 3 (64-bit wide, control words & lines are fetched as 64 bits)
+    position: (hstart,vstart) written in the control words (vstop is computed from the frame height)
+    with_table: if True, the output starts with an offset table: one big endian long per frame,
+    offset of its sprite from the start of the output (aligned on the sprite fetch width)
+    pass None as output_filename to avoid writing to file
+    returns a SpriteSheet: data (output contents), offsets (per frame), nb_sprites (unique frames)
+    """
+    if len(palette) not in (4,16):
+        raise BitplaneException("Palette size must be 4, or 16 for attached sprites")
+    attached = len(palette) == 16
+    if isinstance(input_image,str):
+        imgorg = PIL.Image.open(input_image)
+    else:
+        imgorg = input_image
+    width = SPRITE_WIDTHS[sprite_fmode]
+    fetch_size = width//8
+
+    if frames is None:
+        if frame_size is None:
+            raise BitplaneException("frame_size or frames must be given")
+        frames = spritesheet_grid(imgorg.size,frame_size)
+    for x,y,w,h in frames:
+        if w > width:
+            raise BitplaneException("{} frame at ({},{}) width must be <= {}, found {}".format(input_image,x,y,width,w))
+
+    # all the sheet colors are looked up at once, only frame pixels must match the palette
+    rgb = np.asarray(imgorg.convert("RGB"))
+    in_frames = np.zeros(rgb.shape[:2],dtype=bool)
+    for x,y,w,h in frames:
+        in_frames[y:y+h,x:x+w] = True
+    indexes = _sprite_indexes(input_image,rgb,palette,palette_precision_mask,in_frames)
+
+    # frames of the same height are encoded together, padded to the sprite width with color 0
+    blocks = [None]*len(frames)
+    heights = {}
+    for i,(x,y,w,h) in enumerate(frames):
+        heights.setdefault(h,[]).append(i)
+    for h,frame_numbers in heights.items():
+        stacked = np.zeros((len(frame_numbers),h,width),dtype=indexes.dtype)
+        for j,i in enumerate(frame_numbers):
+            x,y,w,_ = frames[i]
+            stacked[j,:,:w] = indexes[y:y+h,x:x+w]
+        encoded = _sprite_blocks(stacked,0,fetch_size,False,position)
+        if attached:
+            encoded = [even+odd for even,odd in zip(encoded,_sprite_blocks(stacked,2,fetch_size,True,position))]
+        for j,i in enumerate(frame_numbers):
+            blocks[i] = encoded[j]
+
+    table_size = 0
+    if with_table:
+        table_size = -(-len(frames)*4//fetch_size)*fetch_size
+    unique = {}
+    offsets = []
+    next_offset = table_size
+    for block in blocks:
+        if block not in unique:
+            unique[block] = next_offset
+            next_offset += len(block)
+        offsets.append(unique[block])
+
+    out = b"".join(unique)
+    if with_table:
+        table = b"".join(struct.pack(">I",offset) for offset in offsets)
+        out = table+bytes(table_size-len(table))+out
+
+    if output_filename:
+        with open(output_filename,"wb") as f:
+            f.write(out)
+
+    return SpriteSheet(out,offsets,len(unique))
+
 def print_long_hex_array(array):
     print( " ".join(["".join("{:02x}".format(array[i]) for i in range(j,j+4)) for j in range(0,len(array),4)]))
 
@@ -0,0 +1,310 @@
+import PIL.Image,collections,re,struct
+import numpy as np
+
+import bitplanelib
+
+# IFF ILBM reader/writer, on top of the bitplanelib planar encode/decode
+# ILBM bodies are interleaved bitplanes, rows padded to 16 bits, optionally
+# ByteRun1 (PackBits) compressed row by row
+
+CAMG_LACE = 0x4
+CAMG_EHB = 0x80
+CAMG_HAM = 0x800
+CAMG_HIRES = 0x8000
+
+MASKING_NONE = 0
+MASKING_HAS_MASK = 1
+MASKING_TRANSPARENT_COLOR = 2
+
+COMPRESSION_NONE = 0
+COMPRESSION_BYTERUN1 = 1
+
+_BMHD_FORMAT = ">HHhhBBBBHBBhh"
+
+IlbmImage = collections.namedtuple("IlbmImage","width height nb_planes palette indexes camg masking transparent_color")
+
+class IlbmException(bitplanelib.BitplaneException):
+    pass
+
+# 3 or more equal bytes: worth a repeat run, shorter ones are cheaper as literals
+_REPEAT_RUN = re.compile(rb"(.)\1{2,}",re.DOTALL)
+
+def byterun1_pack(data,row_size):
+    """
+    ByteRun1 compresses data row by row (runs don't cross rows, as the ILBM spec requires)
+    row_size: bytes per row (one plane row in ILBM)
+    returns compressed bytes
+    """
+    src = memoryview(bytes(data))
+    out = []
+    for row_start in range(0,len(src),row_size):
+        row = src[row_start:row_start+row_size]
+        literal_start = 0
+        for match in _REPEAT_RUN.finditer(row):
+            start,end = match.span()
+            _pack_literals(row[literal_start:start],out)
+            value = row[start]
+            while start < end:
+                n = min(end-start,128)
+                # a single byte left over can only be a literal
+                out.append(bytes((257-n if n > 1 else 0,value)))
+                start += n
+            literal_start = end
+        _pack_literals(row[literal_start:],out)
+    return b"".join(out)
+
+def _pack_literals(literals,out):
+    for start in range(0,len(literals),128):
+        chunk = literals[start:start+128]
+        out.append(bytes((len(chunk)-1,)))
+        out.append(chunk)
+
+def byterun1_unpack(data,size):
+    """
+    ByteRun1 decompresses data (bytes, memoryview...) into size bytes
+
+    vectorized: the control bytes are found by pointer doubling (the position of the next
+    control byte only depends on the current one), then all the runs are copied by a single
+    gather, literal runs reading consecutive source bytes, repeat runs the same one
+    """
+    src = np.frombuffer(data,dtype=np.uint8)
+    src_size = len(src)
+    positions = np.arange(src_size,dtype=np.int64)
+    codes = src.astype(np.int64)
+    literal = codes < 128
+    # position of the next control byte, src_size past the end
+    jump = np.full(src_size+1,src_size,dtype=np.int64)
+    jump[:-1] = np.minimum(positions+np.where(literal,codes+2,np.where(codes > 128,2,1)),src_size)
+
+    # control bytes: steps [0,2^k[ from the start, then the next 2^k steps, until the end
+    controls = np.zeros(1 if src_size else 0,dtype=np.int64)
+    while len(controls):
+        following = jump[controls]
+        following = following[following < src_size]
+        controls = np.concatenate((controls,following))
+        if len(following) < len(controls)-len(following):
+            break
+        jump = jump[jump]
+
+    # output lengths, literals truncated to the data left, repeats without a data byte dropped
+    starts = controls+1
+    codes = codes[controls]
+    literal = literal[controls]
+    lengths = np.where(literal,np.minimum(codes+1,src_size-starts),np.where((codes > 128) & (starts < src_size),257-codes,0))
+    decompressed = int(lengths.sum())
+    if decompressed < size:
+        raise IlbmException("Truncated BODY: {} bytes decompressed, {} expected".format(decompressed,size))
+
+    offsets = np.cumsum(lengths)-lengths
+    is_literal = np.repeat(literal,lengths)
+    sources = np.repeat(np.where(literal,starts-offsets,starts),lengths)
+    sources[is_literal] += np.flatnonzero(is_literal)
+    return bytearray(src[sources[:size]].tobytes())
+
+def _iff_chunks(data):
+    """
+    yields (chunk id, memoryview of contents) of a FORM contents
+    """
+    pos = 0
+    while pos+8 <= len(data):
+        chunk_id = bytes(data[pos:pos+4])
+        size, = struct.unpack_from(">I",data,pos+4)
+        yield chunk_id,data[pos+8:pos+8+size]
+        # chunks are padded to even sizes
+        pos += 8+size+(size & 1)
+
+def ilbm_read(input_ilbm):
+    """
+    reads an IFF ILBM image
+    input_ilbm: filename or bytes
+    returns an IlbmImage, indexes being a (height,width) numpy array of pixel values
+    (palette indexes, or HAM codes: see ilbm2image)
+    """
+    if isinstance(input_ilbm,str):
+        with open(input_ilbm,"rb") as f:
+            input_ilbm = f.read()
+    data = memoryview(input_ilbm)
+    if len(data) < 12 or data[:4] != b"FORM" or data[8:12] != b"ILBM":
+        raise IlbmException("Not an IFF ILBM file")
+    form_size, = struct.unpack_from(">I",data,4)
+
+    bmhd = None
+    palette = []
+    camg = 0
+    body = None
+    for chunk_id,contents in _iff_chunks(data[12:8+form_size]):
+        if chunk_id == b"BMHD":
+            bmhd = struct.unpack_from(_BMHD_FORMAT,contents)
+        elif chunk_id == b"CMAP":
+            palette = [tuple(contents[i:i+3]) for i in range(0,len(contents)-2,3)]
+        elif chunk_id == b"CAMG":
+            camg, = struct.unpack_from(">I",contents)
+        elif chunk_id == b"BODY":
+            body = contents
+
+    if bmhd is None:
+        raise IlbmException("No BMHD chunk")
+    width,height,_,_,nb_planes,masking,compression,_,transparent_color = bmhd[:9]
+    row_size = ((width+15)//16)*2
+    nb_stored_planes = nb_planes+(masking == MASKING_HAS_MASK)
+    body_size = row_size*nb_stored_planes*height
+
+    if body is None:
+        raise IlbmException("No BODY chunk")
+    if compression == COMPRESSION_BYTERUN1:
+        body = byterun1_unpack(body,body_size)
+    elif compression == COMPRESSION_NONE:
+        if len(body) < body_size:
+            raise IlbmException("Truncated BODY: {} bytes, {} expected".format(len(body),body_size))
+    else:
+        raise IlbmException("Unsupported compression {}".format(compression))
+
+    # interleaved rows, the mask plane (if any) just being skipped
+    layout = (row_size,row_size*(nb_stored_planes-1))
+    indexes = bitplanelib.bitplanes_raw2indexes(body,nb_planes,row_size*8,height,layout)[:,:width]
+    return IlbmImage(width,height,nb_planes,palette,indexes,camg,masking,transparent_color)
+
+def _ham_decode(indexes,palette,nb_planes):
+    """
+    HAM6/HAM8 pixel codes to RGB: each pixel sets a palette color, or modifies one component
+    of the pixel on its left. Vectorized: the source of each component is the last pixel
+    of the row which has set or modified it
+    """
+    height,width = indexes.shape
+    data_bits = nb_planes-2
+    data = (indexes & ((1<<data_bits)-1)).astype(np.int32)
+    control = indexes >> data_bits
+
+    lut = np.zeros((1<<data_bits,3),dtype=np.int32)
+    colors = [tuple(c)[:3] for c in palette[:1<<data_bits]]
+    if colors:
+        lut[:len(colors)] = colors
+    columns = np.broadcast_to(np.arange(width),(height,width))
+
+    # colors set from the palette, the border color (color 0) before the first one
+    set_pos = np.maximum.accumulate(np.where(control == 0,columns,-1),axis=1)
+    base = lut[np.where(set_pos >= 0,np.take_along_axis(data,np.maximum(set_pos,0),axis=1),0)]
+
+    rgb = np.empty((height,width,3),dtype=np.uint8)
+    # control codes: 1: modify blue, 2: modify red, 3: modify green
+    for component,code in ((0,2),(1,3),(2,1)):
+        modified_pos = np.maximum.accumulate(np.where(control == code,columns,-1),axis=1)
+        value = np.take_along_axis(data,np.maximum(modified_pos,0),axis=1)
+        if data_bits == 4:
+            value = value*0x11
+        else:
+            # HAM8 modifies the 6 upper bits only
+            value = (value << 2) | (base[...,component] & 3)
+        rgb[...,component] = np.where(modified_pos > set_pos,value,base[...,component])
+    return rgb
+
+def ilbm2image(input_ilbm,output_filename=None):
+    """
+    converts an IFF ILBM image (filename, bytes or IlbmImage) to a RGB PIL image
+    EHB and HAM (HAM6 & HAM8) images are decoded according to their CAMG flags,
+    24 and 32 planes images as true color (8 planes per component, red first, then alpha)
+    if output_filename is not None, then save as file
+    """
+    if not isinstance(input_ilbm,IlbmImage):
+        input_ilbm = ilbm_read(input_ilbm)
+    palette = [tuple(c)[:3] for c in input_ilbm.palette]
+    nb_planes = input_ilbm.nb_planes
+
+    if input_ilbm.camg & CAMG_HAM and nb_planes in (6,8):
+        rgb = _ham_decode(input_ilbm.indexes,palette,nb_planes)
+    elif nb_planes in (24,32):
+        # deep ILBM: the planes hold the components, no palette
+        rgb = np.stack([(input_ilbm.indexes >> shift).astype(np.uint8) for shift in (0,8,16)],axis=2)
+    elif nb_planes > 16:
+        raise IlbmException("Unsupported number of planes {}".format(nb_planes))
+    else:
+        if input_ilbm.camg & CAMG_EHB and nb_planes == 6:
+            # the half-bright colors are the upper 32 ones, whatever the CMAP size
+            palette = bitplanelib.palette_toehb((palette+[(0,0,0)]*32)[:32])
+        lut = np.zeros((1<<nb_planes,3),dtype=np.uint8)
+        if palette:
+            lut[:len(palette)] = palette[:1<<nb_planes]
+        rgb = lut[input_ilbm.indexes]
+
+    img = PIL.Image.fromarray(rgb)
+    if output_filename:
+        img.save(output_filename)
+    return img
+
+def _chunk(chunk_id,contents):
+    rval = chunk_id+struct.pack(">I",len(contents))+contents
+    return rval+b"\0" if len(contents) & 1 else rval
+
+def _ilbm_form(body,width,height,nb_planes,palette,camg,compress,transparent_color,aspect):
+    """
+    builds the ILBM file contents around an uncompressed BODY
+    """
+    row_size = ((width+15)//16)*2
+    if compress:
+        body = byterun1_pack(body,row_size)
+
+    masking = MASKING_NONE if transparent_color is None else MASKING_TRANSPARENT_COLOR
+    bmhd = struct.pack(_BMHD_FORMAT,width,height,0,0,nb_planes,masking,
+                       COMPRESSION_BYTERUN1 if compress else COMPRESSION_NONE,0,transparent_color or 0,
+                       aspect[0],aspect[1],width,height)
+    chunks = [_chunk(b"BMHD",bmhd),
+              _chunk(b"CMAP",bytes(v for c in palette for v in tuple(c)[:3]))]
+    if camg:
+        chunks.append(_chunk(b"CAMG",struct.pack(">I",camg)))
+    chunks.append(_chunk(b"BODY",body))
+
+    contents = b"ILBM"+b"".join(chunks)
+    return b"FORM"+struct.pack(">I",len(contents))+contents
+
+def _write(output_filename,contents):
+    if output_filename:
+        with open(output_filename,"wb") as f:
+            f.write(contents)
+    return contents
+
+def ilbm_write(output_filename,indexes,palette,nb_planes=None,camg=0,compress=True,
+               transparent_color=None,aspect=(10,11)):
+    """
+    writes an IFF ILBM image
+    indexes: (height,width) array of pixel values (palette indexes, or HAM codes with camg=CAMG_HAM)
+    palette: list of RGB triplets, written in the CMAP chunk
+    nb_planes: number of bitplanes (None: computed from the palette size, 6 with CAMG_EHB)
+    camg: CAMG viewport mode flags (CAMG_EHB, CAMG_HAM, CAMG_HIRES, CAMG_LACE), no CAMG chunk if 0
+    compress: ByteRun1 compression of the BODY
+    transparent_color: palette index set as transparent (masking mode 2)
+    pass None as output_filename to avoid writing to file
+    returns the file contents
+    """
+    indexes = np.asarray(indexes)
+    height,width = indexes.shape
+    if nb_planes is None:
+        nb_planes = 6 if camg & CAMG_EHB else max(1,(len(palette)-1).bit_length())
+
+    # rows are padded to 16 bits
+    padded = np.zeros((height,((width+15)//16)*16),dtype=indexes.dtype)
+    padded[:,:width] = indexes
+    body = bitplanelib.bitplanes_indexes2raw(padded,nb_planes,layout=bitplanelib.BITPLANE_LAYOUT_INTERLEAVED)
+    return _write(output_filename,_ilbm_form(body,width,height,nb_planes,palette,camg,compress,transparent_color,aspect))
+
+def palette_image2ilbm(input_image,output_filename,palette,forced_nb_planes=None,palette_precision_mask=0xFF,
+                       camg=0,compress=True,transparent_color=None,aspect=(10,11)):
+    """
+    converts any image which has the proper number of colors and color match (see palette_image2raw)
+    to an IFF ILBM image
+    pass None as output_filename to avoid writing to file
+    returns the file contents
+    """
+    if isinstance(input_image,str):
+        input_image = PIL.Image.open(input_image)
+    width,height = input_image.size
+    if camg & CAMG_EHB and not forced_nb_planes:
+        forced_nb_planes = 6
+
+    # rows are padded to 16 bits with color 0, then encoded straight to an ILBM BODY
+    padded = PIL.Image.new("RGB",(((width+15)//16)*16,height),tuple(palette[0])[:3])
+    padded.paste(input_image,(0,0))
+    body = bitplanelib.palette_image2raw(padded,None,palette,forced_nb_planes=forced_nb_planes,
+                                         palette_precision_mask=palette_precision_mask,mask_color=None,
+                                         layout=bitplanelib.BITPLANE_LAYOUT_INTERLEAVED)
+    nb_planes = len(body)//(padded.size[0]//8*height) if height else forced_nb_planes or 1
+    return _write(output_filename,_ilbm_form(body,width,height,nb_planes,palette,camg,compress,transparent_color,aspect))
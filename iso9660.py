@@ -0,0 +1,190 @@
+import heapq
+from typing import BinaryIO, NamedTuple
+
+# ISO9660 directory reader, with Joliet and Rock Ridge names, used by search_isos.py
+# Only the volume descriptors and the directories are read, from any seekable binary stream
+# (file, mmap, ZIP member...). Directories are read in disk order, so that compressed streams
+# only seek forward
+
+sector_size = 2048
+first_descriptor_sector = 16
+joliet_escape_sequences = (b'%/@', b'%/C', b'%/E')
+
+
+class IsoError(Exception):
+    pass
+
+
+class IsoEntry(NamedTuple):
+    path: str
+    size: int
+    extent: int
+    is_dir: bool
+    # logical block size of the volume, the unit of extent
+    block_size: int = sector_size
+
+
+def _read(stream: BinaryIO, position: int, size: int) -> bytes:
+    stream.seek(position)
+    data = stream.read(size)
+    if len(data) < size:
+        raise IsoError(f'Truncated image: {size} bytes expected at {position}, {len(data)} read')
+    return data
+
+
+def _volume_roots(stream: BinaryIO) -> tuple[bytes, bytes|None, int]:
+    """Root directory records of the primary volume and of the Joliet volume (if any), and the logical block size"""
+    primary = None
+    joliet = None
+    sector = first_descriptor_sector
+    while True:
+        descriptor = _read(stream, sector * sector_size, sector_size)
+        if descriptor[1:6] != b'CD001':
+            raise IsoError('Not an ISO9660 image')
+        descriptor_type = descriptor[0]
+        if descriptor_type == 1 and primary is None:
+            primary = descriptor
+        elif descriptor_type == 2 and descriptor[88:91] in joliet_escape_sequences:
+            joliet = descriptor
+        elif descriptor_type == 255:
+            break
+        sector += 1
+
+    if primary is None:
+        raise IsoError('No primary volume descriptor')
+    return primary[156:190], joliet[156:190] if joliet is not None else None, int.from_bytes(primary[128:130], 'little')
+
+
+def _rock_ridge_skip(stream: BinaryIO, root: bytes, block_size: int) -> int|None:
+    """
+    Rock Ridge images start the system use area of the root '.' record with a SUSP 'SP' entry
+
+    returns the number of bytes to skip at the start of each system use area, None without Rock Ridge
+    """
+    first_record = _read(stream, int.from_bytes(root[2:6], 'little') * block_size, 255)
+    system_use = first_record[34:first_record[0]]
+    if system_use[:2] == b'SP' and system_use[4:6] == b'\xbe\xef':
+        return system_use[6]
+    return None
+
+
+def _susp_entries(stream: BinaryIO, system_use: bytes, block_size: int):
+    """System use entries (signature, data) of a record, following continuation areas"""
+    areas = [system_use]
+    while areas:
+        data = areas.pop()
+        position = 0
+        while position + 4 <= len(data):
+            signature = data[position:position + 2]
+            length = data[position + 2]
+            if length < 4:
+                break
+            entry = data[position + 4:position + length]
+            if signature == b'CE':
+                block = int.from_bytes(entry[0:4], 'little')
+                offset = int.from_bytes(entry[8:12], 'little')
+                size = int.from_bytes(entry[16:20], 'little')
+                areas.append(_read(stream, block * block_size + offset, size))
+            elif signature == b'ST':
+                break
+            else:
+                yield signature, entry
+            position += length
+
+
+def _rock_ridge_name(stream: BinaryIO, system_use: bytes, block_size: int) -> str|None:
+    name = None
+    for signature, entry in _susp_entries(stream, system_use, block_size):
+        if signature == b'NM' and entry and not entry[0] & 0x06:
+            # parts of the name follow each other (continue flag)
+            name = (name or b'') + entry[1:]
+    return name.decode('utf-8', 'replace') if name is not None else None
+
+
+def _iso_name(name: bytes, joliet: bool) -> str:
+    text = name.decode('utf-16-be', 'replace') if joliet else name.decode('latin-1')
+    # version and trailing dot of names without extension
+    text = text.split(';')[0]
+    return text[:-1] if text.endswith('.') else text
+
+
+def _directory_records(data: bytes, block_size: int):
+    """Records of a directory extent, records don't cross logical blocks"""
+    position = 0
+    while position < len(data):
+        length = data[position]
+        if length == 0:
+            # rest of the block is padding
+            position = (position // block_size + 1) * block_size
+            continue
+        yield data[position:position + length]
+        position += length
+
+
+def iso_entries(stream: BinaryIO, rock_ridge: bool = True) -> list[IsoEntry]:
+    """
+    Lists the files and directories of an ISO9660 image, without reading file data
+
+    stream: seekable binary stream
+    rock_ridge: use Rock Ridge names when present (else Joliet ones, else ISO9660 ones)
+    returns IsoEntry tuples sorted by path, extents being in logical blocks of the volume (entry block_size)
+    """
+    root, joliet_root, block_size = _volume_roots(stream)
+    skip = _rock_ridge_skip(stream, root, block_size) if rock_ridge else None
+    rock_ridge = skip is not None
+    # Rock Ridge names are complete (case, length), Joliet ones are only used without them
+    joliet = not rock_ridge and joliet_root is not None
+    if joliet:
+        root = joliet_root
+
+    entries = []
+    visited = set()
+    # directories in disk order: (extent, size, path)
+    queue = [(int.from_bytes(root[2:6], 'little'), int.from_bytes(root[10:14], 'little'), '')]
+    while queue:
+        extent, size, directory = heapq.heappop(queue)
+        if extent in visited:
+            continue
+        visited.add(extent)
+
+        previous = None
+        for record in _directory_records(_read(stream, extent * block_size, size), block_size):
+            name_length = record[32]
+            name = record[33:33 + name_length]
+            if name in (b'\x00', b'\x01'):
+                continue
+            record_extent = int.from_bytes(record[2:6], 'little')
+            record_size = int.from_bytes(record[10:14], 'little')
+            flags = record[25]
+
+            name = _iso_name(name, joliet)
+            if rock_ridge:
+                system_use = record[33 + name_length + (1 - name_length % 2):]
+                name = _rock_ridge_name(stream, system_use[skip:], block_size) or name
+            path = f'{directory}/{name}' if directory else name
+
+            if previous is not None and previous.path == path:
+                # multi-extent file, sections follow each other
+                entries[-1] = previous = previous._replace(size=previous.size + record_size)
+            elif flags & 0x02:
+                entries.append(IsoEntry(path, record_size, record_extent, True, block_size))
+                heapq.heappush(queue, (record_extent, record_size, path))
+                previous = None
+            else:
+                previous = IsoEntry(path, record_size, record_extent, False, block_size)
+                entries.append(previous)
+
+    entries.sort()
+    return entries
+
+
+def copy_entry(stream: BinaryIO, entry: IsoEntry, output: BinaryIO, buffer_size: int = 1024 * 1024):
+    """Copies the data of a file entry to an output stream, by blocks of buffer_size"""
+    stream.seek(entry.extent * entry.block_size)
+    remaining = entry.size
+    while remaining:
+        data = stream.read(min(buffer_size, remaining))
+        if not data:
+            raise IsoError(f'Truncated image: {entry.path} misses {remaining} bytes')
+        output.write(data)
+        remaining -= len(data)
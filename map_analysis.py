@@ -0,0 +1,129 @@
+import numpy as np
+
+# Analysis of raw map/bitmap dumps, used by map_display.py
+
+# bytes analyzed when looking for the row width, starting at the requested offset
+max_analyzed_bytes = 1 << 20
+# a divisor of a candidate width scoring at least (1 - divisor_tolerance) times as much is ranked
+# instead: repeated rows make all the multiples of the row width look alike
+divisor_tolerance = 0.1
+
+
+def _autocorrelation(data: np.ndarray, max_lag: int) -> np.ndarray:
+    """Normalized autocorrelation of the byte stream for lags 0 to max_lag, computed with a FFT, None for constant data"""
+    x = data.astype(np.float32)
+    x -= x.mean()
+    n = len(x)
+    size = 1 << (2 * n - 1).bit_length()
+    spectrum = np.fft.rfft(x, size)
+    ac = np.fft.irfft(spectrum * np.conj(spectrum), size)[:max_lag + 1]
+    if ac[0] <= 0:
+        # constant data
+        return None
+    # unbiased: compensate the decreasing number of overlapping bytes
+    return ac / ac[0] * n / (n - np.arange(max_lag + 1))
+
+
+def row_similarity(data: np.ndarray, width: int) -> float:
+    """Fraction of bytes equal to the byte one row above"""
+    if width >= len(data):
+        return 0.0
+    return float(np.count_nonzero(data[width:] == data[:-width])) / (len(data) - width)
+
+
+def estimate_offset(data: np.ndarray, width: int) -> int:
+    """Start of the data where rows look alike, to skip a header"""
+    if width * 2 >= len(data):
+        return 0
+    equal = (data[width:] == data[:-width]).astype(np.float32)
+    # density of equal bytes over one row, the header ends where it reaches half its usual level
+    cumulated = np.concatenate(([0], np.cumsum(equal, dtype=np.float64)))
+    density = (cumulated[width:] - cumulated[:-width]) / width
+    level = np.median(density)
+    start = int(np.argmax(density >= level / 2))
+    if start == 0 or level == 0:
+        return 0
+    offset = start + width // 2
+    if equal[:offset].mean() * 2 > level:
+        return 0
+    return offset
+
+
+def rank_row_widths(data, min_width: int = 2, max_width: int = 1024, offset: int = 0, top: int = 10) -> list[tuple[int, int, float]]:
+    """
+    Ranks candidate row widths (in bytes) of a map or bitmap dump
+
+    data: numpy uint8 array (or bytes)
+    returns a list of (width, offset, score), best first. Candidates are replaced by their
+    smallest divisor scoring nearly as well, multiples of a ranked width are skipped
+    """
+    data = np.frombuffer(data, dtype=np.uint8) if not isinstance(data, np.ndarray) else data
+    data = data[offset:offset + max_analyzed_bytes]
+    max_width = min(max_width, len(data) // 2)
+    if max_width < min_width:
+        return []
+
+    ac = _autocorrelation(data, max_width)
+    if ac is None:
+        return []
+    widths = np.arange(min_width, max_width + 1)
+    scores = {}
+
+    def width_score(width):
+        if width not in scores:
+            scores[width] = (max(0.0, float(ac[width])) + row_similarity(data, width)) / 2
+        return scores[width]
+
+    # autocorrelation peaks are the candidates, then rows are compared for the best ones
+    candidates = widths[np.argsort(ac[min_width:])[::-1][:top * 5]]
+    ranked = set()
+    for width in candidates.tolist():
+        threshold = width_score(width) * (1 - divisor_tolerance)
+        divisors = (w for w in range(min_width, width // 2 + 1) if width % w == 0)
+        ranked.add(next((w for w in divisors if width_score(w) >= threshold), width))
+    scored = sorted(((scores[width], width) for width in ranked), key=lambda item: (-item[0], item[1]))
+
+    rval = []
+    for score, width in scored:
+        if any(width % w == 0 and score <= s / (1 - divisor_tolerance) for w, _, s in rval):
+            continue
+        rval.append((width, offset + estimate_offset(data, width), score))
+        if len(rval) == top:
+            break
+    return rval
+
+
+def rgb4_words(data: np.ndarray, parity: int = 0) -> np.ndarray:
+    """Big endian 16-bit words of the data, starting at byte 0 or 1"""
+    data = data[parity:]
+    return np.ascontiguousarray(data[:len(data) // 2 * 2]).view('>u2')
+
+
+def find_rgb4_runs(words: np.ndarray, min_length: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the runs of at least min_length valid RGB4 colors (12-bit values, high nibble zero)
+
+    returns (starts, lengths) arrays, in words
+    """
+    valid = np.concatenate(([False], words < 0x1000, [False]))
+    changes = np.flatnonzero(valid[1:] != valid[:-1])
+    starts = changes[0::2]
+    lengths = changes[1::2] - starts
+    keep = lengths >= min_length
+    return starts[keep], lengths[keep]
+
+
+def clip_runs(starts: np.ndarray, lengths: np.ndarray, start: int, stop: int, min_length: int) -> tuple[np.ndarray, np.ndarray]:
+    """Restricts runs to the [start, stop[ window, relative to start. Runs becoming too short are dropped"""
+    run_starts = np.maximum(starts, start)
+    run_lengths = np.minimum(starts + lengths, stop) - run_starts
+    keep = run_lengths >= min_length
+    return run_starts[keep] - start, run_lengths[keep]
+
+
+def runs_mask(size: int, starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Boolean mask of the values inside the runs"""
+    marks = np.zeros(size + 1, dtype=np.int32)
+    np.add.at(marks, starts, 1)
+    np.add.at(marks, starts + lengths, -1)
+    return np.cumsum(marks[:size]) > 0
@@ -1,22 +1,45 @@
 import colorsys
-import copy
 from enum import Enum, auto
+import mmap
 import os
 import random
-import shutil
 import sys
-import tempfile
 from typing import Optional
 from PySide6 import QtWidgets, QtCore, QtGui
 from PIL import Image
 import numpy as np
 
+import map_analysis
+
 start_offset = 0
 start_width = 60
+redraw_debounce_ms = 30
+max_palette_candidates = 1000
+# rows colored between two checks for a newer render request
+render_chunk_rows = 256
 
 # file_path = os.path.dirname(os.path.realpath(__file__)) + "/data/CursedKingdoms/gfx/ALSEND1DATA"  # Replace with the actual file path
 
 
+def map_file(file_path):
+    """Map a file in memory (read only), returns a numpy uint8 array backed by the mapping"""
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            # empty files can't be mapped
+            return np.zeros(0, dtype=np.uint8)
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return np.frombuffer(mapped, dtype=np.uint8)
+
+
+def rgb4_lookup_table():
+    """ARGB32 colors of the 4096 RGB4 values, nibbles are expanded like in BinaryLoader.amiga_color_to_rgb"""
+    values = np.arange(0x1000, dtype=np.uint32)
+    red = (values >> 8) & 0xF
+    green = (values >> 4) & 0xF
+    blue = values & 0xF
+    return 0xFF000000 | (red * 0x11) << 16 | (green * 0x11) << 8 | blue * 0x11
+
+
 class DisplayMode(Enum):
     HEX = auto()
     BIT = auto()
@@ -24,6 +47,59 @@ class DisplayMode(Enum):
     ASCII = auto()
 
 
+class BitCells():
+    """Bits of a byte buffer seen as cells, only expanded for the requested slices
+
+    With several bitplanes, each cell is a pixel whose value is the index made of the bits
+    of all planes. Planes are either consecutive or interleaved (one row of each plane in turn)
+    """
+
+    def __init__(self, data, bit_offset=0, nb_planes=1, row_width=8, interleaved=False):
+        self.data = data
+        self.bit_offset = bit_offset
+        self.nb_planes = nb_planes
+        self.row_bytes = max(1, row_width // 8)
+        self.interleaved = interleaved
+
+        if nb_planes == 1:
+            self.length = max(0, len(data) * 8 - bit_offset)
+        else:
+            self.data = data[bit_offset // 8:]
+            nb_rows = len(self.data) // (self.row_bytes * nb_planes)
+            self.plane_size = nb_rows * self.row_bytes
+            self.length = self.plane_size * 8
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.length)
+        stop = max(start, stop)
+
+        if self.nb_planes == 1:
+            first_byte = (self.bit_offset + start) // 8
+            last_byte = -(-(self.bit_offset + stop) // 8)
+            skip = self.bit_offset + start - first_byte * 8
+            return np.unpackbits(self.data[first_byte:last_byte])[skip:skip + stop - start]
+
+        row_pixels = self.row_bytes * 8
+        first_row = start // row_pixels
+        rows = np.arange(first_row, -(-stop // row_pixels))
+        columns = np.arange(self.row_bytes)
+
+        values = np.zeros((len(rows), row_pixels), dtype=np.uint8)
+        for plane in range(self.nb_planes):
+            if self.interleaved:
+                row_starts = (rows * self.nb_planes + plane) * self.row_bytes
+            else:
+                row_starts = plane * self.plane_size + rows * self.row_bytes
+            plane_bytes = self.data[row_starts[:, np.newaxis] + columns]
+            values |= np.unpackbits(plane_bytes, axis=1) << plane
+
+        skip = start - first_row * row_pixels
+        return values.ravel()[skip:skip + stop - start]
+
+
 class PaletteManager(QtWidgets.QDialog):
     def __init__(self, palettes, parent=None) -> None:
         super().__init__(parent)
@@ -78,8 +154,7 @@ class MapDisplay(QtWidgets.QMainWindow):
 
         self.binary_loader = BinaryLoader(self)
 
-        self.str_map_array = [str]
-        self.byte_map_buffer = b''
+        self.map_data = np.zeros(0, dtype=np.uint8)
         self.file_path = ''
 
         self.current_width = 0
@@ -89,6 +164,19 @@ class MapDisplay(QtWidgets.QMainWindow):
         self.palette_filenames = []
         self.value_to_color = {}
 
+        # runs of RGB4 colors, per filter/word alignment/minimum length
+        self.palette_runs_cache = {}
+
+        self.render_generation = 0
+        self.render_task = None
+        self.render_pool = QtCore.QThreadPool(self)
+        self.render_pool.setMaxThreadCount(1)
+
+        self.redraw_timer = QtCore.QTimer(self)
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.setInterval(redraw_debounce_ms)
+        self.redraw_timer.timeout.connect(self.start_redraw)
+
         self.setAcceptDrops(True)
 
         # Create a menu bar
@@ -131,6 +219,12 @@ class MapDisplay(QtWidgets.QMainWindow):
         options_menu.addAction(self.display_decimal_toggle_action)
         options_menu.addAction(self.linear_colors_toggle_action)
 
+        self.interleaved_toggle_action = QtGui.QAction('Interleaved bitplanes', self)
+        self.interleaved_toggle_action.setCheckable(True)
+        self.interleaved_toggle_action.setChecked(False)
+        self.interleaved_toggle_action.triggered.connect(self.redraw_map)
+        options_menu.addAction(self.interleaved_toggle_action)
+
         file_menu.addAction(open_action)
         file_menu.addAction(quit_action)
         file_menu.addAction(palettes_action)
@@ -142,7 +236,7 @@ class MapDisplay(QtWidgets.QMainWindow):
         self.create_map_view(start_offset, start_width)
         # self.read_map(file_path)
 
-        self.selection = (0, len(self.str_map_array))
+        self.selection = (0, len(self.map_data))
 
     def dragEnterEvent(self, event):
         if event.mimeData().hasUrls():
@@ -178,12 +272,7 @@ class MapDisplay(QtWidgets.QMainWindow):
         return color
 
     def filter_map(self):
-        filtered_array = []
-        for i, value in enumerate(self.str_map_array):
-            if i % 2 == 1:
-                filtered_array.append(value)
-
-        return filtered_array
+        return self.map_data[1::2]
 
     def set_colors(self):
         seed_value = 42
@@ -195,12 +284,15 @@ class MapDisplay(QtWidgets.QMainWindow):
                 self.value_to_color[i] = self.get_random_color()
 
     def redraw_map(self):
+        # bursts of changes (held keys...) are coalesced, only the last parameters are rendered
+        self.redraw_timer.start()
+
+    def start_redraw(self):
         try:
             row_width = int(self.row_width_edit.text())
             cell_size = int(self.cell_size_edit.text())
             if row_width > 0 and cell_size > 0:
                 offset = int(self.offset_edit.text())
-                self.view.scene().clear()  # Clear the self.canvas
                 self.draw_map(row_width, cell_size, offset)
         except ValueError as e:
             print(e)
@@ -222,32 +314,17 @@ class MapDisplay(QtWidgets.QMainWindow):
         except ValueError:
             pass
 
-    def read_file_as_map(self, file_path, preserve_byte_map=True):
-        with open(file_path, 'rb') as file:
-            byte_map_buffer = file.read()
-
-        if preserve_byte_map:
-            self.byte_map_buffer = byte_map_buffer
-
-        return [hex(byte_pair)[2:].upper().zfill(2) for byte_pair in byte_map_buffer]
-
     def read_map(self, file_path):
-        self.str_map_array = self.read_file_as_map(file_path)
+        self.map_data = self.binary_loader.read_file_as_map(file_path)
+        self.palette_runs_cache = {}
         self.file_path = os.path.basename(file_path)
         self.setWindowTitle(f'Map Data - {self.file_path}')
 
-        self.limit_edit.setText(str(len(self.str_map_array)))
+        self.limit_edit.setText(str(len(self.map_data)))
 
-        filter = True
-        for i, value in enumerate(self.str_map_array):
-            if i % 2 == 0:
-                if value != '00':
-                    filter = False
-                    break
-        if filter:
+        if not self.map_data[0::2].any():
             self.filter_leading_byte_pair_toggle_action.setChecked(True)
             print('Filtering out leading zero byte pairs')
-            self.filter_map()
 
         self.redraw_map()
 
@@ -258,167 +335,195 @@ class MapDisplay(QtWidgets.QMainWindow):
         if file_path:
             self.read_map(file_path)
 
-    def hex_to_binary(self, hex_string):
-        decimal_value = int(hex_string, 16)
-        binary_string = format(decimal_value, '08b')  # '08b' formats the integer as an 8-bit binary string
-        return list(binary_string)
-
-    def erase_noncontinuous_values(self, data, min_occurrence):
-        data_list = []
-
-        start_idx = None
-        count = 0
-
-        for idx, value in enumerate(data):
-            if value[0] == '0':
-                if start_idx is None:
-                    start_idx = idx
-                count += 1
-            else:
-                if start_idx is not None and count >= min_occurrence:
-                    data_list.append((start_idx, idx - 1))
-                start_idx = None
-                count = 0
-
-        if start_idx is not None and count >= min_occurrence:
-            data_list.append((start_idx, len(data) - 1))
-
-        result = ['0000'] * len(data)
-
-        for start, end in data_list:
-            result[start:end+1] = data[start:end+1]
-
-        return result
-
     def select_area(self, start, stop):
-        self.view.scene().clearSelection()
-        for item in self.view.scene().items():
-            if isinstance(item, ClickableRectItem):
-                if item.file_pos >= start and item.file_pos <= stop:
-                    item.setSelected(True)
+        self.view.select_area(start, stop)
 
     def draw_map(self, row_width, cell_size, offset):
-        limit_diff = 0
-        limit = len(self.str_map_array)
+        limit = len(self.map_data)
 
         if self.limit_edit:
             limit = int(self.limit_edit.text())
 
-            if limit != 0:
-                limit_diff = len(self.str_map_array) - limit
-
-        filtered_map = self.str_map_array
-
-        if self.filter_leading_byte_pair_toggle_action.isChecked():
-            filtered_map = self.filter_map()
-
-        cell_size_mult = 1.0
-
-        if self.palette_rows_combo:
-            match self.display_mode:
-                case DisplayMode.HEX | DisplayMode.ASCII:
-                    rows = [filtered_map[i:i + row_width] for i in range(offset, len(filtered_map) - limit_diff, row_width)]
-                case DisplayMode.BIT:
-                    cell_size_mult = 0.2
-                    expanded_bits = [bit for hex_value in filtered_map[:limit] for bit in self.hex_to_binary(hex_value)]
-                    rows = [expanded_bits[i:i + row_width] for i in range(offset, len(expanded_bits), row_width)]
-                case DisplayMode.PALETTE:
-                    # cell_size_mult = 0.5
-                    rows = [''.join(filtered_map[i:i + 2]) for i in range(offset, len(filtered_map) - limit_diff, 2)]
-                    rows = self.erase_noncontinuous_values(rows, int(self.palette_rows_combo.currentText()))
-                    rows = [rows[i:i + row_width] for i in range(0, len(rows), row_width)]
-
-            self.canvas_height = len(rows) * cell_size * cell_size_mult  # Calculate the required self.canvas height
-
-        scene = QtWidgets.QGraphicsScene()
-        self.view.setScene(scene)
+        # snapshot of the parameters, the cells and their colors are computed off the GUI thread
+        map_data = self.map_data
+        display_mode = self.display_mode
+        filter_leading = self.filter_leading_byte_pair_toggle_action.isChecked()
+        palette_length = int(self.palette_rows_combo.currentText())
+        nb_planes = int(self.bit_planes_combo.currentText())
+        interleaved = self.interleaved_toggle_action.isChecked()
+        lut = self.color_lookup_table()
+
+        cell_size_mult = 0.2 if display_mode == DisplayMode.BIT else 1.0
+        if display_mode == DisplayMode.BIT and nb_planes > 1:
+            # rows of planar pixels are made of whole bytes
+            row_width = max(8, row_width - row_width % 8)
+
+        # the runs cache belongs to the GUI thread: missing runs are found by the worker,
+        # and handed back with the rendered map to be cached
+        runs_key = (filter_leading, offset % 2, palette_length)
+        palette_runs = None
+        if display_mode == DisplayMode.PALETTE:
+            palette_runs = self.cached_palette_runs(map_data, runs_key)
+
+        def render(is_cancelled):
+            found_runs = None
+            runs = palette_runs
+            if display_mode == DisplayMode.PALETTE and runs is None:
+                runs = MapDisplay.find_palette_runs(map_data, *runs_key)
+                found_runs = (runs_key, (map_data, *runs))
+                if is_cancelled():
+                    return None
+            cells = MapDisplay.map_cells(map_data, display_mode, row_width, offset, limit, filter_leading, palette_length,
+                                         nb_planes, interleaved, runs)
+            if is_cancelled():
+                return None
+
+            if isinstance(cells, BitCells):
+                # bits are only expanded for the visible rows, by the view
+                return (cells, None, row_width, cell_size, cell_size_mult, lut), found_runs
+
+            # pad the last row with transparent pixels
+            image_data = np.zeros(-(-len(cells) // row_width) * row_width, dtype=np.uint32)
+            chunk_size = render_chunk_rows * row_width
+            for start in range(0, len(cells), chunk_size):
+                if is_cancelled():
+                    return None
+                chunk = cells[start:start + chunk_size]
+                image_data[start:start + len(chunk)] = lut[chunk]
+            return (cells, image_data, row_width, cell_size, cell_size_mult), found_runs
+
+        self.render_generation += 1
+        self.render_pool.clear()  # drop renders which haven't started yet
+
+        self.render_task = MapRenderTask(self.render_generation, lambda: self.render_generation, render)
+        self.render_task.signals.finished.connect(self.on_render_finished)
+        self.render_pool.start(self.render_task)
+
+    def on_render_finished(self, generation, result):
+        # only the latest frame is swapped into the view
+        if generation == self.render_generation:
+            view_args, found_runs = result
+            if found_runs is not None:
+                key, cached = found_runs
+                # runs of a file loaded since are dropped
+                if cached[0] is self.map_data:
+                    self.palette_runs_cache[key] = cached
+            self.view.set_map(*view_args)
+            if self.display_mode == DisplayMode.PALETTE:
+                self.update_palette_candidates()
+
+    def cached_palette_runs(self, map_data, key):
+        """(words, starts, lengths) of map_data cached for key (filter_leading, parity, min_length), None if missing"""
+        cached = self.palette_runs_cache.get(key)
+        if cached is None or cached[0] is not map_data:
+            return None
+        return cached[1:]
+
+    def palette_runs(self, map_data, filter_leading, parity, min_length):
+        """RGB4 words of the file and their runs of valid colors, cached"""
+        key = (filter_leading, parity, min_length)
+        runs = self.cached_palette_runs(map_data, key)
+        if runs is None:
+            runs = MapDisplay.find_palette_runs(map_data, *key)
+            self.palette_runs_cache[key] = (map_data, *runs)
+        return runs
+
+    @staticmethod
+    def find_palette_runs(map_data, filter_leading, parity, min_length):
+        """RGB4 words of the file and their runs of valid colors, run in a worker thread: it only uses its arguments"""
+        words = map_analysis.rgb4_words(map_data[1::2] if filter_leading else map_data, parity)
+        return (words, *map_analysis.find_rgb4_runs(words, min_length))
+
+    def update_palette_candidates(self):
+        try:
+            parity = int(self.offset_edit.text()) % 2
+        except ValueError:
+            parity = 0
+        filter_leading = self.filter_leading_byte_pair_toggle_action.isChecked()
+        min_length = int(self.palette_rows_combo.currentText())
+        words, starts, lengths = self.palette_runs(self.map_data, filter_leading, parity, min_length)
+
+        self.palette_candidates_list.clear()
+        for start, length in zip(starts[:max_palette_candidates].tolist(), lengths[:max_palette_candidates].tolist()):
+            offset = parity + start * 2
+            item = QtWidgets.QListWidgetItem(f'{offset} (${offset:X}): {length} colors')
+            item.setData(QtCore.Qt.ItemDataRole.UserRole, (offset, words[start:start + length]))
+            self.palette_candidates_list.addItem(item)
+
+    def on_palette_candidate_clicked(self, item):
+        offset, _ = item.data(QtCore.Qt.ItemDataRole.UserRole)
+        self.offset_edit.setText(str(offset))
+        self.redraw_map()
 
-        font = QtGui.QFont()
-        font.setFamily('Courier New')
-        font.setPointSize(cell_size // 1.5)
+    def export_palette_candidate(self):
+        item = self.palette_candidates_list.currentItem()
+        if item is None:
+            return
+        offset, words = item.data(QtCore.Qt.ItemDataRole.UserRole)
 
-        counter_font = QtGui.QFont()
-        # counter_font.setFamily('Courier New')
-        counter_font.setPointSize(cell_size // 3)
+        file_name, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Export Palette', f'/tmp/{self.file_path}_{offset:X}.pal', 'All Files (*)')
+        if file_name:
+            # raw RGB4 words, as loaded by the palette manager
+            with open(file_name, 'wb') as file:
+                file.write(words.astype('>u2').tobytes())
+            self.palette_filenames.append(file_name)
+
+    @staticmethod
+    def map_cells(map_data, display_mode, row_width, offset, limit, filter_leading, palette_length, nb_planes=1, interleaved=False,
+                  palette_runs=None):
+        """
+        Cells of the map, run in a worker thread: it only uses its arguments
+        palette_runs: (words, starts, lengths) from palette_runs, for DisplayMode.PALETTE
+        """
+        limit_diff = 0
 
-        counter_text_width = 50
-
-        for row_index, row in enumerate(rows):
-            y1 = 0
-
-            for col_index, element in enumerate(row):
-                text = str(element)
-
-                match self.display_mode:
-                    case DisplayMode.HEX:
-                        bg_color = self.value_to_color.get(int(text, 16), QtGui.QColor(0, 0, 0))
-                    case DisplayMode.BIT:
-                        if text == '0':
-                            bg_color = QtGui.QColor(0, 0, 0)
-                        else:
-                            bg_color = QtGui.QColor(255, 255, 255)
-                    case DisplayMode.PALETTE:
-                        if text[0] == '0':
-                            bg_color = self.binary_loader.amiga_color_to_rgb(text)
-                        else:
-                            bg_color = QtGui.QColor(0, 0, 0)
-                    case DisplayMode.ASCII:
-                        bg_color = QtGui.QColor(255, 255, 255)
-
-                x1 = col_index * cell_size * cell_size_mult + counter_text_width
-                y1 = row_index * cell_size * cell_size_mult
-
-                rect_item = ClickableRectItem(x1, y1, cell_size * cell_size_mult, cell_size * cell_size_mult, row_index * row_width + col_index, self)
-                rect_item.setBrush(bg_color)
-
-                scene.addItem(rect_item)
-
-                # Text
-
-                match self.display_mode:
-                    case DisplayMode.HEX:
-                        if self.display_decimal_toggle_action.isChecked():
-                            text = str(int(text, 16))
-                            font.setPointSize(cell_size // 3)
-                            # font.setPointSizeF(font.pointSize() / 1.06)
-
-                        text_item = QtWidgets.QGraphicsSimpleTextItem(text)
-
-                        text_item.setFont(font)
-                        text_item.setPos(x1 + cell_size // 2 - text_item.boundingRect().width() // 2, y1 + cell_size // 2 - text_item.boundingRect().height() // 2)
-                        scene.addItem(text_item)
-                    case DisplayMode.PALETTE:
-                        text_item = QtWidgets.QGraphicsSimpleTextItem(text)
-
-                        font.setPointSize(cell_size // 3)
-
-                        text_item.setFont(font)
-                        text_item.setPos(x1 + cell_size // 2 - text_item.boundingRect().width() // 2, y1 + cell_size // 2 - text_item.boundingRect().height() // 2)
-                        text_item.setBrush(QtGui.QColor(255, 255, 255))
-                        scene.addItem(text_item)
-                    case DisplayMode.ASCII:
-                        try:
-                            text = bytes.fromhex(text).decode('ASCII')
-                        except:
-                            text = ''
-                        # font.setPointSize(cell_size // 3)
-
-                        text_item = QtWidgets.QGraphicsSimpleTextItem(text)
-
-                        text_item.setFont(font)
-                        text_item.setPos(x1 + cell_size // 2 - text_item.boundingRect().width() // 2, y1 + cell_size // 2 - text_item.boundingRect().height() // 2)
-                        scene.addItem(text_item)
-
-            # Add row counter
-            text_item = QtWidgets.QGraphicsSimpleTextItem(str(row_index * row_width))
-            text_item.setFont(counter_font)
-            text_item.setPos(0, y1 + cell_size // 3 - text_item.boundingRect().height() // 3)
-            text_item.setBrush(QtGui.QColor(255, 255, 255))
-
-            scene.addItem(text_item)
-
-        self.view.setSceneRect(0, 0, cell_size * row_width, self.canvas_height)  # Set the scene rectangle
-        self.view.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarPolicy.ScrollBarAlwaysOn)  # Show the vertical scrollbar
+        if limit != 0:
+            limit_diff = len(map_data) - limit
+
+        filtered_map = map_data
+
+        if filter_leading:
+            filtered_map = map_data[1::2]
+
+        # cells are kept as a flat array, the view cuts them in rows
+        match display_mode:
+            case DisplayMode.HEX | DisplayMode.ASCII:
+                nb_rows = len(range(offset, len(filtered_map) - limit_diff, row_width))
+                cells = filtered_map[offset:offset + nb_rows * row_width]
+            case DisplayMode.BIT:
+                cells = BitCells(filtered_map[:limit], offset, nb_planes, row_width, interleaved)
+            case DisplayMode.PALETTE:
+                # runs are found once over the whole file, then restricted to the window
+                parity = offset % 2
+                words, starts, lengths = palette_runs
+                first_word = (offset - parity) // 2
+                last_word = first_word + (max(offset, len(filtered_map) - limit_diff) - offset) // 2
+                starts, lengths = map_analysis.clip_runs(starts, lengths, first_word, last_word, palette_length)
+
+                cells = words[first_word:last_word]
+                cells = np.where(map_analysis.runs_mask(len(cells), starts, lengths), cells, 0).astype(np.uint16)
+
+        return cells
+
+    def color_lookup_table(self):
+        """ARGB32 cell color for every possible cell value of the current display mode"""
+        match self.display_mode:
+            case DisplayMode.HEX:
+                black = QtGui.QColor(0, 0, 0)
+                return np.array([self.value_to_color.get(i, black).rgb() for i in range(256)], dtype=np.uint32)
+            case DisplayMode.BIT:
+                if int(self.bit_planes_combo.currentText()) > 1:
+                    # pixels colored as indexes
+                    black = QtGui.QColor(0, 0, 0)
+                    return np.array([self.value_to_color.get(i, black).rgb() for i in range(256)], dtype=np.uint32)
+                return np.array([0xFF000000, 0xFFFFFFFF], dtype=np.uint32)
+            case DisplayMode.PALETTE:
+                # invalid colors (high nibble set) are black
+                lut = np.full(0x10000, 0xFF000000, dtype=np.uint32)
+                lut[:0x1000] = rgb4_lookup_table()
+                return lut
+            case DisplayMode.ASCII:
+                return np.full(256, 0xFFFFFFFF, dtype=np.uint32)
 
     def create_map_view(self, offset=0, row_width=16, cell_size=20):
         self.setGeometry(100, 100, 800, 600)
@@ -448,7 +553,7 @@ class MapDisplay(QtWidgets.QMainWindow):
         # Limit
         limit_layout = QtWidgets.QHBoxLayout()
         limit_label = QtWidgets.QLabel('Limit:')
-        self.limit_edit = QtWidgets.QLineEdit(str(len(self.str_map_array)))
+        self.limit_edit = QtWidgets.QLineEdit(str(len(self.map_data)))
         limit_layout.addWidget(limit_label)
         limit_layout.addWidget(self.limit_edit)
 
@@ -485,6 +590,10 @@ class MapDisplay(QtWidgets.QMainWindow):
         merge_button = QtWidgets.QPushButton('Merge')
         merge_button.clicked.connect(lambda: self.merge_bitplanes())
 
+        # Width detection
+        detect_width_button = QtWidgets.QPushButton('Detect Width')
+        detect_width_button.clicked.connect(self.detect_row_widths)
+
         self.row_width_edit.returnPressed.connect(self.redraw_map)
         self.offset_edit.returnPressed.connect(self.redraw_map)
         self.limit_edit.returnPressed.connect(self.redraw_map)
@@ -533,9 +642,19 @@ class MapDisplay(QtWidgets.QMainWindow):
 
         row_layout.addWidget(self.palette_rows_label)
         row_layout.addWidget(self.palette_rows_combo)
+
+        # Number of bitplanes shown in bit mode
+        self.bit_planes_label = QtWidgets.QLabel('Planes:')
+        self.bit_planes_combo = QtWidgets.QComboBox()
+        self.bit_planes_combo.addItems([str(i) for i in range(1, 9)])
+        self.bit_planes_combo.currentIndexChanged.connect(self.redraw_map)
+
+        row_layout.addWidget(self.bit_planes_label)
+        row_layout.addWidget(self.bit_planes_combo)
         row_layout.addWidget(redraw_button)
         row_layout.addWidget(dump_button)
         row_layout.addWidget(merge_button)
+        row_layout.addWidget(detect_width_button)
 
         self.selection_label1 = QtWidgets.QLabel('Sel.:')
         self.selection_label2 = QtWidgets.QLabel('0 - 0')
@@ -544,10 +663,28 @@ class MapDisplay(QtWidgets.QMainWindow):
 
         layout.addLayout(row_layout)
 
-        # self.canvas
-        scene = QtWidgets.QGraphicsScene()
-        self.view = QtWidgets.QGraphicsView(scene)
-        self.view.setScene(scene)
+        self.view = MapView(self)
+
+        # Ranked row widths, click to jump to one
+        self.row_widths_list = QtWidgets.QListWidget(self)
+        self.row_widths_list.itemClicked.connect(self.on_row_width_clicked)
+        row_widths_dock = QtWidgets.QDockWidget('Row Widths', self)
+        row_widths_dock.setWidget(self.row_widths_list)
+        self.addDockWidget(QtCore.Qt.DockWidgetArea.RightDockWidgetArea, row_widths_dock)
+
+        # Palette candidates found in palette mode, click to jump to one
+        palette_candidates_widget = QtWidgets.QWidget()
+        palette_candidates_layout = QtWidgets.QVBoxLayout(palette_candidates_widget)
+        self.palette_candidates_list = QtWidgets.QListWidget(self)
+        self.palette_candidates_list.itemClicked.connect(self.on_palette_candidate_clicked)
+        export_palette_button = QtWidgets.QPushButton('Export Palette')
+        export_palette_button.clicked.connect(self.export_palette_candidate)
+        palette_candidates_layout.addWidget(self.palette_candidates_list)
+        palette_candidates_layout.addWidget(export_palette_button)
+
+        palette_candidates_dock = QtWidgets.QDockWidget('Palette Candidates', self)
+        palette_candidates_dock.setWidget(palette_candidates_widget)
+        self.addDockWidget(QtCore.Qt.DockWidgetArea.RightDockWidgetArea, palette_candidates_dock)
 
         layout.addWidget(self.view)
 
@@ -557,19 +694,37 @@ class MapDisplay(QtWidgets.QMainWindow):
         self.show()
 
     def merge_bitplanes(self):
-        global file_path
-
-        byte_map_buffer = copy.copy(self.byte_map_buffer)
+        self.image_dialog = ImageDisplay(self.map_data, self.file_path, self.palette_filenames)
+        self.image_dialog.exec()
 
-        if len(byte_map_buffer) % 5 != 0:
-            error_message = 'The length of the bytearray must be divisible by 5 to split it into 5 equal pieces.'
-            QtWidgets.QMessageBox.critical(self, 'Error', error_message)
-        else:
-            self.image_dialog = ImageDisplay(self.byte_map_buffer, self.file_path, self.palette_filenames)
-            self.image_dialog.exec()
+    def detect_row_widths(self):
+        map_data = self.map_data
+        if self.filter_leading_byte_pair_toggle_action.isChecked():
+            map_data = self.filter_map()
+
+        self.row_widths_list.clear()
+        for width, offset, score in map_analysis.rank_row_widths(map_data):
+            item = QtWidgets.QListWidgetItem(f'{width} (offset {offset}, score {score:.2f})')
+            item.setData(QtCore.Qt.ItemDataRole.UserRole, (width, offset))
+            self.row_widths_list.addItem(item)
+
+    def on_row_width_clicked(self, item):
+        width, offset = item.data(QtCore.Qt.ItemDataRole.UserRole)
+
+        # widths and offsets are in bytes, convert them to cells
+        match self.display_mode:
+            case DisplayMode.BIT:
+                width *= 8
+                offset *= 8
+            case DisplayMode.PALETTE:
+                width = max(1, width // 2)
+
+        self.row_width_edit.setText(str(width))
+        self.offset_edit.setText(str(offset))
+        self.redraw_map()
 
     def set_max_limit(self):
-        self.limit_edit.setText(str(len(self.str_map_array)))
+        self.limit_edit.setText(str(len(self.map_data)))
         self.redraw_map()
 
     def on_display_mode_change(self, index):
@@ -659,7 +814,7 @@ class MapDisplay(QtWidgets.QMainWindow):
                 case DisplayMode.PALETTE:
                     mult = 2
 
-            binary_data = bytes.fromhex(''.join(self.str_map_array[start * mult:(stop + 1) * mult]))
+            binary_data = self.map_data[start * mult:(stop + 1) * mult].tobytes()
 
             # Write bytes to the binary file
             with open(file_name, 'wb') as file:
@@ -668,31 +823,32 @@ class MapDisplay(QtWidgets.QMainWindow):
 
 class BinaryLoader():
     def __init__(self, parent):
-        self.byte_map_buffer = []
+        self.byte_map_buffer = np.zeros(0, dtype=np.uint8)
         self.parent = parent
 
     def read_file_as_map(self, file_path, preserve_byte_map=True):
-        with open(file_path, 'rb') as file:
-            byte_map_buffer = file.read()
+        byte_map_buffer = map_file(file_path)
 
         if preserve_byte_map:
             self.byte_map_buffer = byte_map_buffer
 
-        return [hex(byte_pair)[2:].upper().zfill(2) for byte_pair in byte_map_buffer]
+        return byte_map_buffer
+
+    def read_palette_words(self, palette_file_path):
+        palette_data = self.read_file_as_map(palette_file_path, preserve_byte_map=False)
+        return [f'{word:04X}' for word in np.ascontiguousarray(palette_data[:len(palette_data) // 2 * 2]).view('>u2').tolist()]
 
     def open_palette(self):
         initial_dir = os.path.dirname(file_path) if file_path else None
         palette_file_path, _ = QtWidgets.QFileDialog.getOpenFileName(self.parent, 'Open Palette Dump', dir=initial_dir)
 
         if palette_file_path:
-            palette_data = self.read_file_as_map(palette_file_path, preserve_byte_map=False)
-            return [''.join(palette_data[i:i + 2]) for i in range(0, len(palette_data), 2)]
+            return self.read_palette_words(palette_file_path)
         return []
 
     def load_palette(self, palette_file_path):
         if palette_file_path:
-            palette_data = self.read_file_as_map(palette_file_path, preserve_byte_map=False)
-            return [''.join(palette_data[i:i + 2]) for i in range(0, len(palette_data), 2)]
+            return self.read_palette_words(palette_file_path)
         return []
 
     def palette_to_rgb(self, palette):
@@ -713,24 +869,47 @@ class BinaryLoader():
 
 
 class ImageDisplay(QtWidgets.QDialog):
+    """Preview of bitplanes merged with a palette
+
+    The bitplanes are decoded once per layout into an array of palette indexes, selecting
+    another palette only applies a new color lookup table to it
+    """
+
+    max_cached_layouts = 8
+
     def __init__(self, byte_map_buffer, filename, palette_filenames, parent=None) -> None:
         super().__init__(parent)
 
         self.binary_loader = BinaryLoader(self)
         self.byte_map_buffer = byte_map_buffer
         self.filename = filename
+        self.indexes_cache = {}
+        self.palette = None
+        self.image = None
 
         layout = QtWidgets.QHBoxLayout()  # Use QHBoxLayout for a horizontal layout
         image_layout = QtWidgets.QVBoxLayout()  # Create layout for the image
         button_layout = QtWidgets.QVBoxLayout()  # Create layout for buttons
         list_layout = QtWidgets.QVBoxLayout()  # Create layout for buttons
 
-        self.pixmap = QtGui.QPixmap(320, 200)
-        self.pixmap.fill(QtGui.QColor(0, 0, 0))
         self.label = QtWidgets.QLabel(self)
-        self.label.setPixmap(self.pixmap)
         image_layout.addWidget(self.label)
 
+        # Layout of the bitplanes
+        layout_form = QtWidgets.QFormLayout()
+        self.planes_spin = self.create_spin_box(1, 8, 5)
+        self.width_spin = self.create_spin_box(8, 4096, 320, step=8)
+        self.height_spin = self.create_spin_box(1, 4096, 200)
+        self.offset_spin = self.create_spin_box(0, max(0, len(byte_map_buffer) - 1), 0)
+        self.interleaved_check = QtWidgets.QCheckBox(self)
+        self.interleaved_check.toggled.connect(self.update_image)
+        layout_form.addRow('Planes:', self.planes_spin)
+        layout_form.addRow('Width:', self.width_spin)
+        layout_form.addRow('Height:', self.height_spin)
+        layout_form.addRow('Offset:', self.offset_spin)
+        layout_form.addRow('Interleaved:', self.interleaved_check)
+        image_layout.addLayout(layout_form)
+
         save_button = QtWidgets.QPushButton('Save', self)
         save_button.clicked.connect(self.save_merged_image)
         button_layout.addWidget(save_button)
@@ -761,24 +940,70 @@ class ImageDisplay(QtWidgets.QDialog):
 
         self.setLayout(layout)
 
-        self.tmp_image = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-
         if self.list_widget.count() > 0:
             self.load_palette(self.list_widget.item(0).text())
+        else:
+            self.update_image()
+
+    def create_spin_box(self, minimum, maximum, value, step=1):
+        spin_box = QtWidgets.QSpinBox(self)
+        spin_box.setRange(minimum, maximum)
+        spin_box.setSingleStep(step)
+        spin_box.setValue(value)
+        spin_box.valueChanged.connect(self.update_image)
+        return spin_box
 
     def on_selection_changed(self):
         selected_items = self.list_widget.selectedItems()
         self.load_palette(selected_items[0].text())
 
     def load_palette(self, palette_filename):
-        from bitplanelib import bitplanes_raw2image
-
-        palette = self.binary_loader.load_palette(palette_filename)
-        rgb_colors = self.binary_loader.palette_to_rgb(palette)
-
-        bitplanes_raw2image(self.byte_map_buffer, 5, 320, 200, self.tmp_image.name, rgb_colors)
-        self.pixmap.load(self.tmp_image.name)
-        self.label.setPixmap(self.pixmap)
+        self.palette = self.binary_loader.load_palette(palette_filename)
+        self.update_image()
+
+    def plane_layout(self):
+        # width is rounded down to whole bytes
+        return (self.planes_spin.value(), max(8, self.width_spin.value() // 8 * 8), self.height_spin.value(),
+                self.offset_spin.value(), self.interleaved_check.isChecked())
+
+    def palette_indexes(self, nb_planes, width, height, offset, interleaved):
+        """Palette indexes of the pixels, the bitplanes are only decoded the first time a layout is used"""
+        key = (nb_planes, width, height, offset, interleaved)
+        indexes = self.indexes_cache.get(key)
+        if indexes is None:
+            from bitplanelib import bitplanes_raw2indexes, BITPLANE_LAYOUT_CONSECUTIVE, BITPLANE_LAYOUT_INTERLEAVED
+
+            data = self.byte_map_buffer[offset:offset + nb_planes * height * width // 8]
+            if len(data) < nb_planes * height * width // 8:
+                # missing data at the end of the file is shown as color 0
+                data = np.concatenate((data, np.zeros(nb_planes * height * width // 8 - len(data), dtype=np.uint8)))
+            layout = BITPLANE_LAYOUT_INTERLEAVED if interleaved else BITPLANE_LAYOUT_CONSECUTIVE
+            indexes = bitplanes_raw2indexes(data, nb_planes, width, height, layout)
+
+            if len(self.indexes_cache) >= self.max_cached_layouts:
+                self.indexes_cache.pop(next(iter(self.indexes_cache)))
+            self.indexes_cache[key] = indexes
+        return indexes
+
+    def color_lookup_table(self, nb_planes):
+        """RGB32 colors of the palette indexes, missing palette colors are black. Without palette, a grey ramp"""
+        nb_colors = 1 << nb_planes
+        if self.palette is None:
+            levels = np.arange(nb_colors, dtype=np.uint32) * 255 // max(1, nb_colors - 1)
+            return 0xFF000000 | levels << 16 | levels << 8 | levels
+        lut = np.full(nb_colors, 0xFF000000, dtype=np.uint32)
+        colors = [int(color, 16) & 0xFFF for color in self.palette[:nb_colors]]
+        lut[:len(colors)] = rgb4_lookup_table()[colors]
+        return lut
+
+    def update_image(self):
+        nb_planes, width, height, offset, interleaved = self.plane_layout()
+        image_data = self.color_lookup_table(nb_planes)[self.palette_indexes(nb_planes, width, height, offset, interleaved)]
+
+        # the image uses the array memory, keep both together
+        self.image_data = image_data
+        self.image = QtGui.QImage(image_data.data, width, height, width * 4, QtGui.QImage.Format.Format_RGB32)
+        self.label.setPixmap(QtGui.QPixmap.fromImage(self.image))
 
     def save_merged_image(self):
         global file_path
@@ -789,77 +1014,255 @@ class ImageDisplay(QtWidgets.QDialog):
             if not save_path.lower().endswith('.png'):
                 save_path += '.png'
 
-            shutil.move(self.tmp_image.name, save_path)
-            self.tmp_image.close()
+            self.image.save(save_path, 'PNG')
             self.close()
 
 
-class ClickableRectItem(QtWidgets.QGraphicsRectItem):
-    def __init__(self, x, y, width, height, file_pos, map_display: MapDisplay):
-        super().__init__(x, y, width, height)
-        self.setBrush(QtGui.Qt.GlobalColor.white)
-        self.setPen(QtGui.Qt.PenStyle.NoPen)
-        self.setAcceptHoverEvents(True)  # Enable hover events
-        self.setFlags(QtWidgets.QGraphicsRectItem.GraphicsItemFlag.ItemIsSelectable)  # Enable selection
+class MapRenderSignals(QtCore.QObject):
+    finished = QtCore.Signal(int, object)
 
-        self.file_pos = file_pos
+
+class MapRenderTask(QtCore.QRunnable):
+    """Runs a map render in a worker thread, the render is cancelled when a newer one is requested"""
+
+    def __init__(self, generation, current_generation, render):
+        super().__init__()
+        self.generation = generation
+        self.current_generation = current_generation
+        self.render = render
+        self.signals = MapRenderSignals()
+
+    def is_cancelled(self):
+        return self.generation != self.current_generation()
+
+    def run(self):
+        if self.is_cancelled():
+            return
+        result = self.render(self.is_cancelled)
+        if result is not None and not self.is_cancelled():
+            self.signals.finished.emit(self.generation, result)
+
+
+class MapView(QtWidgets.QAbstractScrollArea):
+    """Map of cells only painting the visible rows, cells positions are computed from the mouse position
+
+    Cell colors are rendered once in an image (one pixel per cell), which is drawn scaled
+    """
+    counter_text_width = 50
+    # minimum cell size in pixels to draw texts
+    legible_cell_extent = 12
+
+    def __init__(self, map_display: MapDisplay):
+        super().__init__()
         self.map_display = map_display
 
-    def mousePressEvent(self, event):
-        if event.button() == QtGui.Qt.MouseButton.LeftButton:
-            self.scene().clearSelection()
-            self.setSelected(True)
-
-            start, stop = self.map_display.selection
-            if event.modifiers() == QtGui.Qt.KeyboardModifier.NoModifier:
-                start = self.file_pos
-                stop = start
-                self.map_display.selection = (start, stop)
-                # self.map_display.selection = (self.file_pos, self.file_pos)
-            elif event.modifiers() == QtGui.Qt.KeyboardModifier.ShiftModifier:
-                new_stop = self.file_pos
-                if new_stop < start:  # Switch values if new_stop is less than start
-                    start, stop = new_stop, start
-                else:
-                    stop = new_stop
-                self.map_display.select_area(start, stop)
-                self.map_display.selection = (start, stop)
-            elif event.modifiers() == QtGui.Qt.KeyboardModifier.AltModifier:
-                start = self.file_pos
-                stop = start + int(self.map_display.palette_rows_combo.currentText()) - 1
-                self.map_display.select_area(start, stop)
-                self.map_display.selection = (start, stop)
+        self.cells = np.zeros(0, dtype=np.uint8)
+        self.lut = None
+        self.image_data = np.zeros((0, 1), dtype=np.uint32)
+        self.image = QtGui.QImage()
+        self.row_width = 1
+        self.cell_size = 20
+        self.cell_extent = 20.0
+        self.selected = None
+
+        self.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarPolicy.ScrollBarAlwaysOn)  # Show the vertical scrollbar
+
+    def set_map(self, cells, image_data, row_width, cell_size, cell_size_mult, lut=None):
+        """
+        cells: flat array of cell values (or BitCells)
+        image_data: ARGB32 color of each cell, padded to full rows.
+        If None, colors of the visible cells are looked up in lut when painting
+        """
+        self.cells = cells
+        self.row_width = row_width
+        self.lut = lut
+
+        self.image_data = image_data
+        if image_data is not None:
+            self.image = QtGui.QImage(self.image_data.data, row_width, self.row_count(), row_width * 4, QtGui.QImage.Format.Format_ARGB32)
+
+        self.cell_size = cell_size
+        self.cell_extent = cell_size * cell_size_mult
+        self.selected = None
+
+        self.update_scrollbars()
+        self.viewport().update()
+
+    def row_count(self):
+        return -(-len(self.cells) // self.row_width)
+
+    def update_scrollbars(self):
+        viewport_size = self.viewport().size()
+        content_width = int(self.counter_text_width + self.row_width * self.cell_extent)
+        content_height = int(self.row_count() * self.cell_extent)
+
+        self.horizontalScrollBar().setRange(0, max(0, content_width - viewport_size.width()))
+        self.horizontalScrollBar().setPageStep(viewport_size.width())
+        self.verticalScrollBar().setRange(0, max(0, content_height - viewport_size.height()))
+        self.verticalScrollBar().setPageStep(viewport_size.height())
+        self.verticalScrollBar().setSingleStep(max(1, int(self.cell_extent)))
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.update_scrollbars()
+
+    def scrollContentsBy(self, dx, dy):
+        self.viewport().update()
+
+    def cell_at(self, pos) -> Optional[int]:
+        x = pos.x() + self.horizontalScrollBar().value() - self.counter_text_width
+        y = pos.y() + self.verticalScrollBar().value()
+        if x < 0 or y < 0:
+            return None
+        col_index = int(x // self.cell_extent)
+        row_index = int(y // self.cell_extent)
+        file_pos = row_index * self.row_width + col_index
+        if col_index >= self.row_width or file_pos >= len(self.cells):
+            return None
+        return file_pos
+
+    def select_area(self, start, stop):
+        self.selected = (start, stop)
+        self.viewport().update()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self.viewport())
+
+        extent = self.cell_extent
+        cell_size = self.cell_size
+        scroll_x = self.horizontalScrollBar().value()
+        scroll_y = self.verticalScrollBar().value()
+        viewport_size = self.viewport().size()
+
+        # only the rows and columns in the window are painted
+        first_row = int(scroll_y // extent)
+        last_row = min(self.row_count(), int((scroll_y + viewport_size.height()) // extent) + 1)
+        first_col = max(0, int((scroll_x - self.counter_text_width) // extent))
+        last_col = min(self.row_width, int((scroll_x + viewport_size.width() - self.counter_text_width) // extent) + 1)
+
+        if last_row <= first_row:
+            painter.end()
+            return
+
+        # cells colors: one scaled blit of the visible rows
+        image = self.image
+        image_first_row = first_row
+        if self.image_data is None:
+            visible_cells = self.cells[first_row * self.row_width:last_row * self.row_width]
+            visible_data = np.zeros((last_row - first_row) * self.row_width, dtype=np.uint32)
+            visible_data[:len(visible_cells)] = self.lut[visible_cells]
+            image = QtGui.QImage(visible_data.data, self.row_width, last_row - first_row, self.row_width * 4, QtGui.QImage.Format.Format_ARGB32)
+            image_first_row = 0
+
+        painter.drawImage(QtCore.QRectF(self.counter_text_width - scroll_x, first_row * extent - scroll_y, self.row_width * extent, (last_row - first_row) * extent),
+                          image,
+                          QtCore.QRectF(0, image_first_row, self.row_width, last_row - first_row))
+
+        display_mode = self.map_display.display_mode
+
+        if extent >= self.legible_cell_extent and display_mode != DisplayMode.BIT:
+            font = QtGui.QFont()
+            font.setFamily('Courier New')
+            font.setPointSize(cell_size // 1.5)
+            if display_mode == DisplayMode.PALETTE or (display_mode == DisplayMode.HEX and self.map_display.display_decimal_toggle_action.isChecked()):
+                font.setPointSize(cell_size // 3)
+            painter.setFont(font)
+
+            if display_mode == DisplayMode.PALETTE:
+                painter.setPen(QtGui.QColor(255, 255, 255))
             else:
-                super().mousePressEvent(event)
+                painter.setPen(QtGui.QColor(0, 0, 0))
+
+            for row_index in range(first_row, last_row):
+                y1 = row_index * extent - scroll_y
+                row_start = row_index * self.row_width
+                row = self.cells[row_start + first_col:row_start + last_col].tolist()
+
+                for col_index, element in enumerate(row, first_col):
+                    # cell text is only formatted for the painted cells
+                    match display_mode:
+                        case DisplayMode.HEX:
+                            if self.map_display.display_decimal_toggle_action.isChecked():
+                                text = str(element)
+                            else:
+                                text = f'{element:02X}'
+                        case DisplayMode.PALETTE:
+                            text = f'{element:04X}'
+                        case DisplayMode.ASCII:
+                            text = chr(element) if element < 0x80 else ''
+
+                    if text:
+                        x1 = col_index * extent + self.counter_text_width - scroll_x
+                        painter.drawText(QtCore.QRectF(x1, y1, extent, extent), QtCore.Qt.AlignmentFlag.AlignCenter, text)
+
+        # selection outline, one rectangle per row
+        if self.selected:
+            selection_pen = QtGui.QPen(QtGui.QColor(0, 0, 0))
+            selection_pen.setStyle(QtCore.Qt.PenStyle.DashLine)
+            painter.setPen(selection_pen)
+            painter.setBrush(QtCore.Qt.BrushStyle.NoBrush)
+
+            start, stop = self.selected
+            for row_index in range(max(first_row, start // self.row_width), min(last_row, stop // self.row_width + 1)):
+                row_start = row_index * self.row_width
+                col_start = max(start, row_start) - row_start
+                col_stop = min(stop, row_start + self.row_width - 1, len(self.cells) - 1) - row_start
+                painter.drawRect(QtCore.QRectF(col_start * extent + self.counter_text_width - scroll_x, row_index * extent - scroll_y, (col_stop - col_start + 1) * extent, extent))
+
+        # Add row counters, spaced enough to be readable
+        counter_font = QtGui.QFont()
+        # counter_font.setFamily('Courier New')
+        counter_font.setPointSize(cell_size // 3)
+        painter.setFont(counter_font)
+        painter.setPen(QtGui.QColor(255, 255, 255))
 
-            start, stop = self.map_display.selection
-            self.map_display.selection_label2.setText(f'{start} - {stop} ({stop-start+1})')
+        counter_step = max(1, int(-(-self.legible_cell_extent // extent)))
+        for row_index in range(first_row - first_row % counter_step, last_row, counter_step):
+            painter.drawText(QtCore.QRectF(-scroll_x, row_index * extent - scroll_y, self.counter_text_width, max(extent, self.legible_cell_extent)),
+                             QtCore.Qt.AlignmentFlag.AlignVCenter, str(row_index * self.row_width))
 
-    def mouseReleaseEvent(self, event) -> None:
-        if event.button() == QtGui.Qt.MouseButton.LeftButton:
-            if event.modifiers() == QtGui.Qt.KeyboardModifier.ShiftModifier or event.modifiers() == QtGui.Qt.KeyboardModifier.AltModifier:
-                pass
-            else:
-                return super().mouseReleaseEvent(event)
+        painter.end()
 
-    def contextMenuEvent(self, event):
-        multiple = False
+    def mousePressEvent(self, event):
+        file_pos = self.cell_at(event.position())
+        if event.button() != QtCore.Qt.MouseButton.LeftButton or file_pos is None:
+            return super().mousePressEvent(event)
+
+        start, stop = self.map_display.selection
+        if event.modifiers() == QtCore.Qt.KeyboardModifier.NoModifier:
+            start = file_pos
+            stop = start
+            self.map_display.select_area(start, stop)
+            self.map_display.selection = (start, stop)
+        elif event.modifiers() == QtCore.Qt.KeyboardModifier.ShiftModifier:
+            new_stop = file_pos
+            if new_stop < start:  # Switch values if new_stop is less than start
+                start, stop = new_stop, start
+            else:
+                stop = new_stop
+            self.map_display.select_area(start, stop)
+            self.map_display.selection = (start, stop)
+        elif event.modifiers() == QtCore.Qt.KeyboardModifier.AltModifier:
+            start = file_pos
+            stop = start + int(self.map_display.palette_rows_combo.currentText()) - 1
+            self.map_display.select_area(start, stop)
+            self.map_display.selection = (start, stop)
+        else:
+            return super().mousePressEvent(event)
 
-        items = self.scene().selectedItems()
-        if len(self.scene().selectedItems()) > 0:
-            if self in items:
-                multiple = True
+        start, stop = self.map_display.selection
+        self.map_display.selection_label2.setText(f'{start} - {stop} ({stop-start+1})')
 
-        menu = QtWidgets.QMenu()
+    def contextMenuEvent(self, event):
+        file_pos = self.cell_at(event.pos())
 
-        if multiple:
+        if self.selected and file_pos is not None and self.selected[0] <= file_pos <= self.selected[1]:
+            menu = QtWidgets.QMenu()
             action1 = menu.addAction('Dump selection')
-            action = menu.exec(event.screenPos())
+            action = menu.exec(event.globalPos())
 
             if action == action1:
                 self.map_display.dump_selection()
-        else:
-            pass
 
 
 if __name__ == '__main__':
@@ -0,0 +1,229 @@
+import argparse, collections, mmap, os, sys
+
+import numpy as np
+
+import bitplanelib
+import map_analysis
+from bitplanelib import PALETTE_FORMATS
+
+# Scans binary dumps (WinUAE state files, memory dumps...) for RGB4 palettes,
+# stored as plain 16-bit words or as copper list color register moves
+# Example: palette_scan.py dump.uss -n 5 --format copperlist -o palettes
+
+palette_sizes = (8, 16, 32, 64)
+# files are scanned by chunks, each one overlapping the next one by a full palette
+chunk_size = 16 << 20
+chunk_overlap = max(palette_sizes) * 4
+# candidates scored at once, bounds the memory used by the gathered palettes
+score_batch_size = 1 << 16
+# copper lists: MOVE to COLOR00, COLOR01... (32 registers, AGA banks aren't followed)
+copper_color00 = 0x180
+copper_max_colors = 32
+# structured data, much less likely to be found by chance than a run of words
+copper_bonus = 1.0
+default_min_score = 2.5
+
+PaletteCandidate = collections.namedtuple("PaletteCandidate", "offset size kind score colors")
+
+
+def score_palettes(palettes: np.ndarray) -> np.ndarray:
+    """
+    Heuristic likelihood of RGB4 word rows being palettes: color 0 black, many distinct colors,
+    gradients (small steps between neighbour colors, monotonic brightness)
+
+    palettes: (n, size) array of 12-bit values
+    returns n scores, 0 for rows with less than 4 distinct colors
+    """
+    palettes = palettes.astype(np.int16)
+    size = palettes.shape[1]
+    black_first = palettes[:, 0] == 0
+
+    ordered = np.sort(palettes, axis=1)
+    distinct = 1 + np.count_nonzero(np.diff(ordered, axis=1), axis=1)
+
+    channels = [(palettes >> shift) & 0xF for shift in (8, 4, 0)]
+    step = np.max([np.abs(np.diff(c, axis=1)) for c in channels], axis=0)
+    gradient = np.count_nonzero((step > 0) & (step <= 2), axis=1) / (size - 1)
+
+    brightness = np.diff(channels[0] * 3 + channels[1] * 6 + channels[2], axis=1)
+    monotonic = np.maximum(np.count_nonzero(brightness > 0, axis=1), np.count_nonzero(brightness < 0, axis=1)) / (size - 1)
+
+    score = black_first + 2.0 * distinct / size + gradient + 0.5 * monotonic
+    return np.where(distinct >= 4, score, 0.0)
+
+
+def _score_windows(words: np.ndarray, positions: np.ndarray, size: int, stride: int = 1) -> np.ndarray:
+    """Scores the palettes of size words (every stride words) starting at positions"""
+    scores = np.empty(len(positions))
+    steps = np.arange(size) * stride
+    for start in range(0, len(positions), score_batch_size):
+        batch = positions[start:start + score_batch_size]
+        scores[start:start + score_batch_size] = score_palettes(words[batch[:, None] + steps])
+    return scores
+
+
+def rgb4_candidates(words: np.ndarray, min_score: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Finds palettes stored as consecutive RGB4 words
+
+    Palettes are looked for at the start of the runs of valid words, and after zero words
+    (black color 0 following padding or another zeroed area). The best scored size is kept
+    for each position
+    returns (positions, sizes, scores) arrays, positions in words
+    """
+    starts, lengths = map_analysis.find_rgb4_runs(words, min(palette_sizes))
+    if len(starts) == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+    inside = map_analysis.runs_mask(len(words), starts, lengths)
+    black = np.flatnonzero(inside[:-1] & (words[:-1] == 0) & (words[1:] != 0))
+    positions = np.union1d(starts, black)
+    available = (starts + lengths)[np.searchsorted(starts, positions, side='right') - 1] - positions
+
+    found = [[], [], []]
+    for size in palette_sizes:
+        sized = positions[available >= size]
+        found[0].append(sized)
+        found[1].append(np.full(len(sized), size))
+        found[2].append(_score_windows(words, sized, size))
+    positions, sizes, scores = (np.concatenate(f) for f in found)
+
+    # best size for each position, the largest one on a tie
+    order = np.lexsort((-sizes, -scores, positions))
+    first = np.concatenate(([True], positions[order][1:] != positions[order][:-1]))
+    order = order[first]
+    order = order[scores[order] >= min_score]
+    return positions[order], sizes[order], scores[order]
+
+
+def copper_candidates(words: np.ndarray, min_score: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Finds palettes set by a copper list: MOVE instructions to consecutive color registers from COLOR00
+
+    returns (positions, sizes, scores) arrays, positions in words (of the first MOVE)
+    """
+    positions = np.flatnonzero(words[:-1] == copper_color00)
+    sizes = np.zeros(len(positions), np.int64)
+    alive = np.ones(len(positions), bool)
+    for color in range(copper_max_colors):
+        register = positions + 2 * color
+        alive &= register + 1 < len(words)
+        alive[alive] = (words[register[alive]] == copper_color00 + 2 * color) & (words[register[alive] + 1] < 0x1000)
+        sizes += alive
+
+    keep = sizes >= min(palette_sizes)
+    positions, sizes = positions[keep], sizes[keep]
+    scores = np.zeros(len(positions))
+    for size in np.unique(sizes).tolist():
+        sized = sizes == size
+        scores[sized] = _score_windows(words, positions[sized] + 1, size, stride=2) + copper_bonus
+    keep = scores >= min_score
+    return positions[keep], sizes[keep], scores[keep]
+
+
+def _candidate_bytes(size: int, kind: str) -> int:
+    return size * (4 if kind == "copper" else 2)
+
+
+def _select(candidates, top: int) -> list:
+    """Best scored candidates, skipping the ones overlapping a better candidate"""
+    rval = []
+    for c in sorted(candidates, key=lambda c: (-c.score, c.offset)):
+        end = c.offset + _candidate_bytes(c.size, c.kind)
+        if all(end <= r.offset or c.offset >= r.offset + _candidate_bytes(r.size, r.kind) for r in rval):
+            rval.append(c)
+            if len(rval) == top:
+                break
+    return rval
+
+
+def _chunk_candidates(data: np.ndarray, base: int, first: int, stop: int, min_score: float, top: int) -> list:
+    """Candidates of a chunk starting at file offset base, restricted to the chunk bytes [first, stop["""
+    candidates = []
+    for parity in (0, 1):
+        words = map_analysis.rgb4_words(data, parity)
+        for kind, finder in (("rgb4", rgb4_candidates), ("copper", copper_candidates)):
+            positions, sizes, scores = finder(words, min_score)
+            offsets = positions * 2 + parity
+            keep = np.flatnonzero((offsets >= first) & (offsets < stop))
+            # overlapping candidates come in clusters, keep enough of them to select the top ones
+            keep = keep[np.argsort(-scores[keep], kind='stable')[:top * max(palette_sizes)]]
+            candidates += [PaletteCandidate(base + offset, size, kind, score, None) for offset, size, score in
+                           zip(offsets[keep].tolist(), sizes[keep].tolist(), scores[keep].tolist())]
+    return _select(candidates, top)
+
+
+def _colors(data: np.ndarray, candidate: PaletteCandidate) -> list[int]:
+    words = data[candidate.offset:candidate.offset + _candidate_bytes(candidate.size, candidate.kind)]
+    words = np.ascontiguousarray(words).view('>u2')
+    if candidate.kind == "copper":
+        words = words[1::2]
+    return words.tolist()
+
+
+def scan_palettes(data, top: int = 10, min_score: float = default_min_score) -> list[PaletteCandidate]:
+    """
+    Scans a dump for palettes
+
+    data: numpy uint8 array (or bytes), possibly backed by a mmap
+    returns the top best scored PaletteCandidate (offsets in bytes, colors as RGB4 values),
+    candidates overlapping a better one are skipped
+    """
+    data = np.frombuffer(data, dtype=np.uint8) if not isinstance(data, np.ndarray) else data
+    candidates = []
+    for base in range(0, len(data), chunk_size):
+        # 2 bytes of context: a run continuing from the previous chunk isn't mistaken for a run start
+        start = max(base - 2, 0)
+        chunk = data[start:base + chunk_size + chunk_overlap]
+        candidates += _chunk_candidates(chunk, start, base - start, base - start + chunk_size, min_score, top)
+    return [c._replace(colors=_colors(data, c)) for c in _select(candidates, top)]
+
+
+def scan_file(filename: str, top: int = 10, min_score: float = default_min_score) -> list[PaletteCandidate]:
+    """Scans a file, mapped in memory so it doesn't have to fit in it"""
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = np.frombuffer(mm, dtype=np.uint8)
+            try:
+                return scan_palettes(data, top, min_score)
+            finally:
+                # the mmap can't be closed while exported
+                del data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="finds RGB4 palettes in binary dumps")
+    parser.add_argument("files", nargs="+", help="dump files")
+    parser.add_argument("-n", "--top", type=int, default=10, help="number of palettes reported per file (default: 10)")
+    parser.add_argument("--min-score", type=float, default=default_min_score, help=f"minimum palette score (default: {default_min_score})")
+    parser.add_argument("-f", "--format", action="append", choices=sorted(PALETTE_FORMATS),
+                        help="dump the palettes in this format, can be repeated (ex: -f asmgnu -f copperlist)")
+    parser.add_argument("-o", "--output", default=None, help="directory receiving one palette file per candidate (default: dump to stdout)")
+    args = parser.parse_args()
+
+    pformat = 0
+    for name in args.format or []:
+        pformat |= PALETTE_FORMATS[name]
+    if pformat & (bitplanelib.PALETTE_FORMAT_BINARY | bitplanelib.PALETTE_FORMAT_PNG) and not args.output:
+        parser.error("binary and png formats need an output directory")
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    extension = "png" if pformat & bitplanelib.PALETTE_FORMAT_PNG else "bin" if pformat & bitplanelib.PALETTE_FORMAT_BINARY else "s"
+
+    for filename in args.files:
+        for candidate in scan_file(filename, args.top, args.min_score):
+            print(f"{filename}: ${candidate.offset:08x} {candidate.kind:<6} {candidate.size:2} colors, score {candidate.score:.2f}")
+            if not pformat:
+                continue
+            palette = bitplanelib.palette_rgb42palette(candidate.colors)
+            if args.output:
+                name = f"{os.path.basename(filename)}_{candidate.offset:08x}.{extension}"
+                bitplanelib.palette_dump(palette, os.path.join(args.output, name), pformat)
+            else:
+                bitplanelib.palette_dump(palette, sys.stdout, pformat)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
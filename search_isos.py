@@ -1,124 +1,417 @@
+import contextlib
+import fnmatch
+import functools
+import io
+import itertools
+import multiprocessing
 import ntpath
 import os
+import sqlite3
 import sys
-import tempfile
 import zipfile
 import re
-import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO
+
+import iso9660
 
 # Searches zipped iso files in directory for matching filenames and optionally extracts them
 # Example: search_isos.py x ^med\. \.med$ ^mod\. \.mod$
+# search_isos.py i indexes the ISO contents, searches then use the index instead of reading the archives
+# (the ZIPs added or changed since are indexed first), --no-index reads the archives anyway
+# --jobs N reads N archives at once, the output stays in the order of the archives
+# --glob or --fixed take the patterns as shell wildcards (*.mod) or as plain strings instead of regexes,
+# wildcards without / match the file name, the other ones the full path
 
 directory_path = '/mnt/Daten/Emulation/ROMs/Commodore/Amiga/CD/'
+# extracted files are copied out of the ISOs by blocks of this size, memory use doesn't depend on the file size
+copy_buffer_size = 16 * 1024 * 1024
+extract_path = '/tmp/test'
+index_path = os.path.expanduser('~/.search_isos.sqlite')
+# indexes with another schema version are rebuilt
+index_version = 2
+# with --jobs, the number of workers extracting at once (disk writes)
+max_concurrent_extractions = 2
+# shared by the workers of a pool
+extract_semaphore = contextlib.nullcontext()
+# regex made of literal characters only (escaped metacharacters)
+literal_regex = re.compile(r'(?:[^\\.^$*+?{}\[\]|()]|\\[^A-Za-z0-9])+')
+# regex parts breaking (or broken by) an alternation of named groups: numbered backreferences,
+# named groups and backreferences, global inline flags
+uncombinable_regex = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?[aiLmsux]+\)')
 
 
-def extract_paths_from_ls_output(ls_output: str) -> list[str]:
-    path_pattern = r'\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2}\s\.\.\.\.\.\s+\d+\s+\d+\s+(.*)'
-    return [match.group(1) for match in re.finditer(path_pattern, ls_output)]
-
-
-def list_iso_content(filename: str) -> str|None:
+def extract_iso_content(iso_file: BinaryIO, entry: iso9660.IsoEntry, output_path: str) -> str|None:
+    """Extracts a file of an ISO into output_path, keeping its path in the ISO"""
+    target = os.path.normpath(os.path.join(output_path, entry.path))
+    if not target.startswith(os.path.normpath(output_path) + os.sep):
+        print(f"Error occurred: {entry.path} is outside of {output_path}")
+        return None
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    created = False
     try:
-        result = subprocess.run(
-            ['7z',
-             'l',
-             filename],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            check=True
-        )
-        return result.stdout
-    except subprocess.CalledProcessError as e:
+        with open(target, 'wb') as output:
+            created = True
+            iso9660.copy_entry(iso_file, entry, output, copy_buffer_size)
+    except BaseException as e:
+        # truncated image or interrupted (Ctrl-C), no partial file is left behind
+        if created:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(target)
+        if not isinstance(e, iso9660.IsoError):
+            raise
         print(f"Error occurred: {e}")
         return None
+    return target
 
 
-def extract_iso_content(archive_filename: str, filename: str, output_path: str) -> str|None:
-    # folder_path = os.path.join(output_path, os.path.dirname(filename))
-    # os.makedirs(folder_path, exist_ok=True)
-    folder_path = output_path
-    try:
-        result=subprocess.run(
-            ['7z',
-             'e',
-             archive_filename,
-             filename,
-             '-o' + folder_path,
-             '-spf',
-             '-aoa'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            check=True
-        )
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        print(f"Error occurred: {e}")
-        return None
+def _literal_suffix(pattern: str, mode: str) -> str|None:
+    """Fixed end of path matched by a pattern (\\.mod$, *.mod), None for other patterns"""
+    if mode == 'glob':
+        if len(pattern) > 1 and pattern[0] == '*' and not any(c in pattern[1:] for c in '*?['):
+            return pattern[1:]
+    elif mode == 'regex':
+        if pattern.endswith('$') and literal_regex.fullmatch(pattern[:-1]):
+            return re.sub(r'\\(.)', r'\1', pattern[:-1])
+    return None
+
+
+def _alternation(regexes: list[tuple[str, str]]) -> tuple:
+    """
+    Combines (pattern, regex) tuples into a single alternation of non-capturing groups
+
+    returns the alternation (None without combined regexes), the combined (pattern, compiled regex)
+    and the ones to test one at a time
+    """
+    combined = []
+    separate = []
+    for pattern, regex in regexes:
+        compiled = re.compile(regex, re.IGNORECASE)
+        (separate if uncombinable_regex.search(regex) else combined).append((pattern, regex, compiled))
+    alternation = None
+    if combined:
+        try:
+            alternation = re.compile('|'.join(f'(?:{regex})' for _, regex, _ in combined), re.IGNORECASE)
+        except re.error:
+            separate += combined
+            combined = []
+    return (alternation, [(pattern, compiled) for pattern, _, compiled in combined],
+            [(pattern, compiled) for pattern, _, compiled in separate])
+
+
+class PathMatcher:
+    """
+    Search patterns compiled once, calling it returns the patterns a path matches (case insensitive)
+
+    Suffix patterns (most searches) are looked up in sets of path ends, by length, fixed strings
+    are searched in the lowered path. Regexes and wildcards are combined into a single alternation,
+    so a path is tested in one pass. Only matching paths are tested again, to report all the patterns
+    they match
+    """
+    def __init__(self, patterns: list[str], mode: str = 'regex'):
+        self.patterns = list(patterns)
+        self.mode = mode
+        self.suffixes = {}
+        self.substrings = []
+        # wildcards without / match the file name
+        on_path = []
+        on_name = []
+        for pattern in self.patterns:
+            suffix = _literal_suffix(pattern, mode)
+            if suffix is not None:
+                self.suffixes.setdefault(len(suffix), {}).setdefault(suffix.lower(), []).append(pattern)
+            elif mode == 'fixed':
+                self.substrings.append((pattern, pattern.lower()))
+            elif mode == 'glob':
+                (on_path if '/' in pattern else on_name).append((pattern, fnmatch.translate(pattern)))
+            else:
+                on_path.append((pattern, pattern))
+
+        # translated wildcards are anchored at the end only
+        self.test = re.Pattern.match if mode == 'glob' else re.Pattern.search
+        self.checks = [(name, *_alternation(regexes)) for name, regexes in ((False, on_path), (True, on_name)) if regexes]
+        self.order = {pattern: i for i, pattern in reversed(list(enumerate(self.patterns)))}
+
+    def __reduce__(self):
+        # sent to the workers as the patterns, compiled once per worker
+        return _cached_matcher, (tuple(self.patterns), self.mode)
+
+    def __call__(self, path: str) -> list[str]:
+        lower = path.lower()
+        matched = set()
+        for length, table in self.suffixes.items():
+            matched.update(table.get(lower[-length:], ()))
+        matched.update(pattern for pattern, substring in self.substrings if substring in lower)
+        test = self.test
+        for name, alternation, combined, separate in self.checks:
+            subject = path.rsplit('/', 1)[-1] if name else path
+            matched.update(pattern for pattern, regex in separate if test(regex, subject))
+            if alternation is not None and test(alternation, subject):
+                # the alternation only tells the first pattern matching at the leftmost position
+                matched.update(pattern for pattern, regex in combined if pattern not in matched and test(regex, subject))
+        return sorted(matched, key=self.order.get)
 
 
-def search_strings_by_regex(string_list: list, regex_pattern: str) -> list[str]:
-    matching_strings=[]
-    regex=re.compile(regex_pattern, re.IGNORECASE)
+@functools.lru_cache
+def _cached_matcher(patterns: tuple[str, ...], mode: str) -> PathMatcher:
+    return PathMatcher(patterns, mode)
 
-    for string in string_list:
-        if regex.search(string):
-            matching_strings.append(string)
 
-    return matching_strings
+def compile_patterns(patterns: list[str], mode: str = 'regex') -> PathMatcher:
+    """Compiles search patterns once (see PathMatcher), raises re.error on an invalid regex"""
+    return PathMatcher(patterns, mode)
 
 
-def check_iso_zip(filename: str, pattern: str, extract: bool):
+def search_strings_by_regex(string_list: list, regex_patterns: list[str]) -> list[str]:
+    """Strings matching any of the patterns, in their original order"""
+    matched_patterns = compile_patterns(regex_patterns)
+    return [string for string in string_list if matched_patterns(string)]
+
+
+def iso_members(zip_archive: zipfile.ZipFile):
+    """ISOs of a ZIP file, as (member info, ISO stream, file entries). The ISO is read from the ZIP member,
+    only its directories are decompressed"""
+    for info in zip_archive.infolist():
+        if info.filename.lower().endswith('.iso'):
+            with zip_archive.open(info) as iso_file:
+                try:
+                    entries = [entry for entry in iso9660.iso_entries(iso_file) if not entry.is_dir]
+                except iso9660.IsoError as e:
+                    print(f"Error occurred: {info.filename}: {e}")
+                    continue
+                yield info, iso_file, entries
+
+
+def report_matches(filename: str, matches: list[tuple[iso9660.IsoEntry, list[str]]], extract: bool, iso_file: BinaryIO|None = None):
+    """matches: (entry, patterns it matches) tuples"""
+    if extract:
+        print(f'Found matches in {filename}, and extracting')
+        with extract_semaphore:
+            # in disk order, the decompression only goes forward
+            for entry, _ in sorted(matches, key=lambda match: match[0].extent):
+                extract_iso_content(iso_file, entry, extract_path)
+    else:
+        print(f'Found matches in {filename}')
+        for entry, patterns in matches:
+            print(f'{entry.path}  [{", ".join(patterns)}]')
+
+
+def check_iso_zip(filename: str, matched_patterns: PathMatcher, extract: bool):
     print(f'Checking {filename}')
-    with tempfile.TemporaryDirectory() as temp_dir:
+    with zipfile.ZipFile(filename, 'r') as zip_archive:
+        for _, iso_file, entries in iso_members(zip_archive):
+            matches = [(entry, matched) for entry in entries for matched in (matched_patterns(entry.path),) if matched]
+
+            if matches:
+                report_matches(filename, matches, extract, iso_file)
+
+
+def zip_files(directory: str) -> list[str]:
+    zip_filenames = []
+    for root, _, files in os.walk(directory):
+        for file in sorted(files):
+            if file.lower().endswith('.zip'):
+                zip_filenames.append(os.path.join(root, file))
+    return zip_filenames
+
+
+def _init_worker(semaphore):
+    global extract_semaphore
+    extract_semaphore = semaphore
+
+
+def _captured(function, *arguments):
+    """Runs a function in a worker, its output is returned to be printed by the main process"""
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        result = function(*arguments)
+    return result, output.getvalue()
+
+
+def run_jobs(function, argument_lists: list[tuple], jobs: int):
+    """
+    Yields the results of function for each argument tuple, in order
+
+    With more than one job, the calls are spread over a process pool, their output is printed
+    as soon as the previous calls are done, so it doesn't depend on the scheduling.
+    On Ctrl-C the queued calls are cancelled, the running ones interrupted
+    """
+    if jobs <= 1:
+        for arguments in argument_lists:
+            yield function(*arguments)
+        return
+
+    semaphore = multiprocessing.Semaphore(max_concurrent_extractions)
+    executor = ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(semaphore,))
+    try:
+        futures = [executor.submit(_captured, function, *arguments) for arguments in argument_lists]
+        for future in futures:
+            result, output = future.result()
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            yield result
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def open_index(filename: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(filename)
+    connection.execute('PRAGMA foreign_keys = ON')
+    if connection.execute('PRAGMA user_version').fetchone()[0] != index_version:
+        connection.executescript(f'''
+            DROP TABLE IF EXISTS files;
+            DROP TABLE IF EXISTS isos;
+            DROP TABLE IF EXISTS zips;
+            PRAGMA user_version = {index_version};
+        ''')
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS zips (id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER);
+        CREATE TABLE IF NOT EXISTS isos (id INTEGER PRIMARY KEY, zip_id INTEGER REFERENCES zips(id) ON DELETE CASCADE,
+                                         name TEXT, size INTEGER, crc INTEGER, block_size INTEGER);
+        CREATE TABLE IF NOT EXISTS files (iso_id INTEGER REFERENCES isos(id) ON DELETE CASCADE,
+                                          path TEXT, size INTEGER, extent INTEGER);
+        CREATE INDEX IF NOT EXISTS isos_zip ON isos(zip_id);
+        CREATE INDEX IF NOT EXISTS files_iso ON files(iso_id);
+    ''')
+    return connection
+
+
+def zip_listing(filename: str) -> list[tuple]|None:
+    """ISO listings of a ZIP file, as (member name, size, CRC, file entries), None if it can't be read"""
+    print(f'Indexing {filename}')
+    try:
         with zipfile.ZipFile(filename, 'r') as zip_archive:
-            for zip_filename in zip_archive.namelist():
-                if zip_filename.lower().endswith('.iso'):
-                    # Extract the ISO file to the temporary directory
-                    extracted_path=os.path.join(temp_dir, os.path.basename(zip_filename))
-                    with zip_archive.open(zip_filename) as iso_file, open(extracted_path, 'wb') as temp_iso:
-                        temp_iso.write(iso_file.read())
-
-                    output=list_iso_content(extracted_path)
-
-                    if output:
-                        paths=extract_paths_from_ls_output(output)
-                        matching_strings=search_strings_by_regex(paths, pattern)
-
-                        if matching_strings:
-                            if extract:
-                                print(f'Found matches in {filename}, and extracting')
-                                for match in matching_strings:
-                                    extract_iso_content(extracted_path, match, '/tmp/test')
-                            else:
-                                print(f'Found matches in {filename}')
-                                for match in matching_strings:
-                                    print(match)
+            return [(info.filename, info.file_size, info.CRC, entries) for info, _, entries in iso_members(zip_archive)]
+    except zipfile.BadZipFile as e:
+        print(f"Error occurred: {filename}: {e}")
+        return None
+
+
+def index_zip(connection: sqlite3.Connection, filename: str, stat: os.stat_result, listing: list[tuple]|None):
+    connection.execute('DELETE FROM zips WHERE path = ?', (filename,))
+    # unreadable ZIPs are indexed anyway, they are only read again once changed
+    zip_id = connection.execute('INSERT INTO zips (path, mtime, size) VALUES (?, ?, ?)',
+                                (filename, stat.st_mtime, stat.st_size)).lastrowid
+    for name, size, crc, entries in listing or []:
+        block_size = entries[0].block_size if entries else iso9660.sector_size
+        iso_id = connection.execute('INSERT INTO isos (zip_id, name, size, crc, block_size) VALUES (?, ?, ?, ?, ?)',
+                                    (zip_id, name, size, crc, block_size)).lastrowid
+        connection.executemany('INSERT INTO files (iso_id, path, size, extent) VALUES (?, ?, ?, ?)',
+                               [(iso_id, entry.path, entry.size, entry.extent) for entry in entries])
+
+
+def update_index(connection: sqlite3.Connection, directory: str, jobs: int = 1):
+    """Indexes the new and changed ZIP files (by mtime and size) of the directory, forgets the removed ones"""
+    indexed = {path: (mtime, size) for path, mtime, size in connection.execute('SELECT path, mtime, size FROM zips')}
+    found = zip_files(directory)
+    changed = []
+    for filename in found:
+        stat = os.stat(filename)
+        if indexed.get(filename) != (stat.st_mtime, stat.st_size):
+            changed.append((filename, stat))
+
+    listings = run_jobs(zip_listing, [(filename,) for filename, _ in changed], jobs)
+    for (filename, stat), listing in zip(changed, listings):
+        index_zip(connection, filename, stat, listing)
+        # an interrupted update keeps what is done
+        connection.commit()
+
+    for filename in indexed.keys() - set(found):
+        print(f'Removing {filename}')
+        connection.execute('DELETE FROM zips WHERE path = ?', (filename,))
+    connection.commit()
+
+
+def search_index(connection: sqlite3.Connection, matched_patterns: PathMatcher, extract: bool):
+    """Searches the index, archives are only opened to extract the matches"""
+    # the matched patterns as lines, NULL when none
+    connection.create_function('matched_patterns', 1, lambda path: '\n'.join(matched_patterns(path)) or None, deterministic=True)
+    # LIMIT -1 keeps the subquery from being flattened, which would call matched_patterns twice per file
+    rows = connection.execute('''
+        SELECT * FROM (
+            SELECT zips.path, isos.name, files.path, files.size, files.extent, isos.block_size,
+                   matched_patterns(files.path) AS matched FROM files
+            JOIN isos ON isos.id = files.iso_id JOIN zips ON zips.id = isos.zip_id LIMIT -1
+        ) WHERE matched IS NOT NULL ORDER BY 1, 2, 3
+    ''')
+    for (filename, iso_name), iso_rows in itertools.groupby(rows, key=lambda row: row[:2]):
+        matches = [(iso9660.IsoEntry(path, size, extent, False, block_size), matched.split('\n'))
+                   for _, _, path, size, extent, block_size, matched in iso_rows]
+        if extract:
+            with zipfile.ZipFile(filename, 'r') as zip_archive, zip_archive.open(iso_name) as iso_file:
+                report_matches(filename, matches, extract, iso_file)
+        else:
+            report_matches(filename, matches, extract)
 
 
 def main():
-    if len(sys.argv) < 3:
-        print('Usage: search_isos.py [s | x] [pattern1 pattern2 ...]')
+    arguments = sys.argv[1:]
+    jobs = 1
+    if '--jobs' in arguments:
+        position = arguments.index('--jobs')
+        try:
+            jobs = int(arguments[position + 1])
+        except (IndexError, ValueError):
+            print('--jobs needs a number of archives read at once')
+            return
+        del arguments[position:position + 2]
+    use_index = '--no-index' not in arguments
+    if not use_index:
+        arguments.remove('--no-index')
+    mode = 'regex'
+    for flag in ('--glob', '--fixed'):
+        if flag in arguments:
+            arguments.remove(flag)
+            mode = flag[2:]
+
+    if len(arguments) < 1 or (len(arguments) < 2 and arguments[0].lower() != 'i'):
+        print('Usage: search_isos.py [s | x] [--jobs N] [--glob | --fixed] [--no-index] [pattern1 pattern2 ...]')
+        print('       search_isos.py i [--jobs N]')
         return
 
-    option=sys.argv[1].lower()
-    arguments=sys.argv[2:]
+    option=arguments[0].lower()
+    arguments=arguments[1:]
 
     extract = False
 
-    if option == 's':
+    if option == 'i':
+        with contextlib.closing(open_index(index_path)) as connection:
+            try:
+                update_index(connection, directory_path, jobs)
+            except KeyboardInterrupt:
+                print('Interrupted')
+        return
+    elif option == 's':
         pass
     elif option == 'x':
         extract = True
     else:
-        print("Invalid option. Use 's' for searching or 'x' for extracting.")
+        print("Invalid option. Use 's' for searching, 'x' for extracting or 'i' for indexing.")
+        return
 
-    for root, _, files in os.walk(directory_path):
-        for file in sorted(files):
-            if file.lower().endswith('.zip'):
-                for argument in arguments:
-                    check_iso_zip(os.path.join(root, file), argument, extract)
+    try:
+        matched_patterns = compile_patterns(arguments, mode)
+    except re.error as e:
+        print(f"Invalid pattern: {e.pattern}: {e}")
+        return
+
+    if use_index and os.path.exists(index_path):
+        # search the index built by the 'i' option, brought up to date first: the stored extents
+        # are only valid for unchanged ZIPs
+        with contextlib.closing(open_index(index_path)) as connection:
+            try:
+                update_index(connection, directory_path, jobs)
+            except KeyboardInterrupt:
+                print('Interrupted')
+                return
+            search_index(connection, matched_patterns, extract)
+        return
+
+    # each archive is read once, for all the patterns
+    try:
+        for _ in run_jobs(check_iso_zip, [(filename, matched_patterns, extract) for filename in zip_files(directory_path)], jobs):
+            pass
+    except KeyboardInterrupt:
+        print('Interrupted')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,19 @@
+import numpy as np
+
+import map_analysis
+
+
+def repeated_rows(width: int, nb_rows: int, noise: float, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    data = np.tile(rng.integers(0, 256, width, dtype=np.uint8), nb_rows)
+    noisy = rng.random(len(data)) < noise
+    data[noisy] = rng.integers(0, 256, int(noisy.sum()), dtype=np.uint8)
+    return data
+
+
+def test_repeated_rows_rank_the_row_width_first():
+    for width in (37, 40, 64):
+        for noise in (0, 0.1):
+            ranked = map_analysis.rank_row_widths(repeated_rows(width, 200, noise))
+            assert ranked[0][0] == width, (width, noise, ranked[:3])
+            assert not any(w % width == 0 for w, _, _ in ranked[1:])